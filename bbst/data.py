@@ -1,8 +1,15 @@
 
+import os
 import uuid
-import random
 import logging
-from dataclasses import dataclass, field
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from operator import attrgetter
+from dataclasses import dataclass, field, fields, replace
+
+from bbst.transliteration import char_map, replace_illegal_characters, transliterate_all
+
 
 logger = logging.getLogger('bbst.data')
 
@@ -10,96 +17,173 @@ logger = logging.getLogger('bbst.data')
 PASSWORD_LENGTH = 10
 
 
-### map translating all illegal characters into legal (ascii) characters
-char_map = {'ä': 'ae',
-            'à': 'a',
-            'á': 'a',
-            'â': 'a',
-            'ã': 'a',
-            'Ä': 'Ae',
-            'À': 'A',
-            'Á': 'A',
-            'Â': 'A',
-            'Ã': 'A',
-            'è': 'e',
-            'é': 'e',
-            'ê': 'e',
-            'È': 'E',
-            'É': 'E',
-            'Ê': 'E',
-            'ö': 'oe',
-            'ò': 'o',
-            'ó': 'o',
-            'ô': 'o',
-            'õ': 'o',
-            'Ö': 'Oe',
-            'Ò': 'O',
-            'Ó': 'O',
-            'Ô': 'O',
-            'Õ': 'O',
-            'ü': 'ue',
-            'ù': 'u',
-            'ú': 'u',
-            'û': 'u',
-            'Ü': 'Ue',
-            'Ù': 'U',
-            'Ú': 'U',
-            'Û': 'U',
-            'í': 'i',
-            'ß': 'ss',
-            'Ç': 'C',
-            'ç': 'c',
-            'č': 'c',
-            'ć': 'c',
-            '´': '',
-            '-': '',
-            ' ': '',
-            'š': 's'}
-
-
-def replace_illegal_characters(string):
-    """Replaces illegal characters from a given string with values from char map."""
-    characters = list(string)
-    return ''.join([char_map[char] if char in char_map else char for char in characters])
+def _format_username(first_name, last_name):
+    return 'KOL.{}{}'.format(last_name[0:4].upper(), first_name[0:4].upper())
 
+def _format_mail_address(last_name):
+    return '{}@bbs-brinkstrasse.de'.format(last_name.lower())
+
+@lru_cache(maxsize=8192)
 def generate_username(first_name, last_name):
-    return 'KOL.{}{}'.format(replace_illegal_characters(last_name)[0:4].upper(),
-                             replace_illegal_characters(first_name)[0:4].upper())
+    return _format_username(replace_illegal_characters(first_name),
+                            replace_illegal_characters(last_name))
 
+@lru_cache(maxsize=8192)
 def generate_mail_address(last_name):
-    return '{}@bbs-brinkstrasse.de'.format(replace_illegal_characters(last_name).lower())
+    return _format_mail_address(replace_illegal_characters(last_name))
 
-def generate_good_readable_password():
+def generate_account_names(names):
+    """
+    Derives user names and mail addresses for many teachers at once. Names
+    occurring multiple times are transliterated only once.
+
+    :param names: iterable of tuples containing first and last name
+    :return: list of tuples containing user name and mail address
+    """
+    names = list(names)
+    first_names = transliterate_all(first_name for first_name, _ in names)
+    last_names = transliterate_all(last_name for _, last_name in names)
+    return [(_format_username(first_name, last_name), _format_mail_address(last_name))
+            for first_name, last_name in zip(first_names, last_names)]
+
+# define possible characters for use in passwords (source: https://www.grc.com/ppp.htm)
+UPPERCASE = 'ABCDEFGHJKLMNPRSTUVWXYZ'
+LOWERCASE = 'abcdefghijkmnopqrstuvwxyz'
+DIGITS = '23456789'
+SPECIALCHARS = '!?%&-+*'
+
+
+@dataclass(frozen=True)
+class PasswordPolicy:
+    """Length and characters of generated passwords."""
+    length: int = PASSWORD_LENGTH
+    # every password contains at least one character of each of these classes
+    required_classes: tuple = (UPPERCASE, LOWERCASE, DIGITS, SPECIALCHARS)
+    # characters used to fill up the password after all required characters
+    fill_characters: str = UPPERCASE + LOWERCASE + DIGITS
+
+
+class _RandomBuffer:
+    """Provides uniformly distributed random numbers from a buffer filled by os.urandom()."""
+    def __init__(self, size):
+        self._size = max(size, 64)
+        self._buffer = os.urandom(self._size)
+        self._position = 0
+
+    def _next_bytes(self, count):
+        if self._position + count > len(self._buffer):
+            self._buffer = os.urandom(self._size)
+            self._position = 0
+        data = self._buffer[self._position:self._position+count]
+        self._position += count
+        return int.from_bytes(data, 'big')
+
+    def below(self, n):
+        """Returns a random number in the range [0, n) using rejection sampling."""
+        count = max(1, ((n - 1).bit_length() + 7) // 8)
+        limit = 256 ** count - (256 ** count) % n
+        while True:
+            value = self._next_bytes(count)
+            if value < limit:
+                return value % n
+
+def generate_passwords(count, policy=None):
+    """
+    Generate a given number of random passwords. All random numbers are taken
+    from a single buffer filled by os.urandom(). Characters are chosen by
+    rejection sampling, so that every character of a class is equally likely.
+
+    :param count: number of passwords to generate
+    :param policy: PasswordPolicy defining length and characters of all
+                   passwords, default is PasswordPolicy()
+    :return: list of strings containing random passwords
+    """
+    policy = policy or PasswordPolicy()
+    if policy.length < len(policy.required_classes):
+        raise ValueError('Password length is too short for all required character classes.')
+    # reserve enough random bytes for most passwords, including rejected ones
+    buffer = _RandomBuffer(count * policy.length * 2)
+    passwords = []
+    for _ in range(count):
+        # fill up with at least one character of every required class
+        password = [c[buffer.below(len(c))] for c in policy.required_classes]
+        # fill password up with more characters
+        fill = policy.fill_characters
+        password += [fill[buffer.below(len(fill))] for _ in range(policy.length-len(password))]
+        # shuffle characters of password string (Fisher-Yates)
+        for i in range(len(password)-1, 0, -1):
+            j = buffer.below(i+1)
+            password[i], password[j] = password[j], password[i]
+        passwords.append(''.join(password))
+    return passwords
+
+def generate_good_readable_password(policy=None):
     """
     Generate a random password for a given length including all letters and
     digits. This password contains at least one lower case letter, one upper
-    case letter and one digit. To generate unpredictable passwords, the
-    SystemRandom class from the random module is used! All ambiguous characters
+    case letter and one digit. To generate unpredictable passwords, all
+    random numbers are read from os.urandom(). All ambiguous characters
     are exempt from passwords.
 
     Source: https://stackoverflow.com/questions/55556/characters-to-avoid-in-automatically-generated-passwords
    
+    :param policy: PasswordPolicy defining length and characters of password
     :return: string containing random password of good quality
     """
-    password = []
-    # define possible characters for use in passwords (source: https://www.grc.com/ppp.htm)
-    uppercase = 'ABCDEFGHJKLMNPRSTUVWXYZ'
-    lowercase = 'abcdefghijkmnopqrstuvwxyz'
-    digits = '23456789'
-    specialchars = '!?%&-+*'
-    chars = uppercase + lowercase + digits
-    # fill up with at least one uppercase, one lowercase, one digit and one special character
-    password += random.SystemRandom().choice(uppercase)
-    password += random.SystemRandom().choice(lowercase)
-    password += random.SystemRandom().choice(digits)
-    password += random.SystemRandom().choice(specialchars)
-    # fill password up with more characters
-    password += [random.SystemRandom().choice(chars) for _ in range(PASSWORD_LENGTH-4)]
-    # shuffle characters of password string
-    random.shuffle(password)
-    logger.debug('New password generated: ' + ''.join(password))
-    return ''.join(password)
+    password = generate_passwords(1, policy)[0]
+    logger.debug('New password generated: ' + password)
+    return password
+
+
+class PasswordPool:
+    """
+    Hands out passwords that were generated in batches, so that creating many
+    teachers does not generate every password on its own.
+    """
+    def __init__(self, policy=None, batch_size=256):
+        self.batch_size = batch_size
+        self._policy = policy or PasswordPolicy()
+        self._passwords = []
+        self._pid = os.getpid()
+
+    @property
+    def policy(self):
+        return self._policy
+
+    @policy.setter
+    def policy(self, policy):
+        self._policy = policy
+        self._passwords = []
+
+    def __call__(self):
+        # never hand out the same passwords in a forked process
+        if self._pid != os.getpid():
+            self._passwords = []
+            self._pid = os.getpid()
+        if not self._passwords:
+            self._passwords = generate_passwords(self.batch_size, self._policy)
+        return self._passwords.pop()
 
+
+# pool providing the passwords for new teachers, the policy for all new
+# passwords can be changed by setting password_pool.policy
+password_pool = PasswordPool()
+
+def _add_slots(cls):
+    """
+    Recreates a dataclass with __slots__ for all its fields, so that instances
+    do not need their own __dict__. (Python 3.10 adds dataclass(slots=True).)
+    """
+    cls_dict = dict(cls.__dict__)
+    field_names = tuple(f.name for f in fields(cls))
+    cls_dict['__slots__'] = field_names
+    for name in field_names:
+        cls_dict.pop(name, None)
+    cls_dict.pop('__dict__', None)
+    cls_dict.pop('__weakref__', None)
+    return type(cls)(cls.__name__, cls.__bases__, cls_dict)
+
+@_add_slots
 @dataclass() #frozen=True
 class Teacher:
     guid: str = field(default_factory=uuid.uuid4)
@@ -107,7 +191,7 @@ class Teacher:
     first_name: str = field(default='', compare=False)
     email: str = field(default='', compare=False)
     username: str = field(default='', compare=False)
-    password: str = field(default_factory=generate_good_readable_password, compare=False)
+    password: str = field(default_factory=password_pool, compare=False)
     # signals that teacher was added after initial import into Repo, either by the add or update command
     added: bool = field(default=False, compare=False, repr=False)
     # signals that teacher was deleted after initial import into Repo by the delete command
@@ -115,3 +199,376 @@ class Teacher:
 
     def __str__(self):
         return '<{} {}>'.format(self.first_name, self.last_name)
+
+
+def teachers_from_rows(rows):
+    """
+    Converts rows read from an export (e.g. BbsvRow objects) into teachers.
+    User names and mail addresses of all rows are derived in a single batch.
+    Entries that already are Teacher objects are passed through unchanged.
+    """
+    rows = list(rows)
+    accounts = iter(generate_account_names((r.first_name, r.last_name) for r in rows
+                                           if not isinstance(r, Teacher)))
+    teachers = []
+    for r in rows:
+        if not isinstance(r, Teacher):
+            username, email = next(accounts)
+            r = Teacher(guid=r.guid, last_name=r.last_name, first_name=r.first_name,
+                        email=email, username=username, added=r.added, deleted=r.deleted)
+        teachers.append(r)
+    return teachers
+
+
+# names of all fields of a teacher in the order used by CSV files and tables
+TEACHER_FIELDS = tuple(f.name for f in fields(Teacher))
+
+# returns all fields of a teacher as tuple without copying them like astuple()
+teacher_row = attrgetter(*TEACHER_FIELDS)
+
+
+NameCollision = namedtuple('NameCollision', ['teacher', 'field', 'original', 'assigned'])
+
+
+class AccountNameIndex:
+    """
+    Index of all user names and mail addresses in a repo. Clashing names of
+    new teachers are made unique by appending the next free number, e.g.
+    KOL.MUELANNA2 or mueller2@bbs-brinkstrasse.de. All changed names are
+    recorded as collisions.
+    """
+    def __init__(self, teachers=()):
+        self._names = {'username': set(), 'email': set()}
+        # next number to try for every clashing name
+        self._next_suffix = {}
+        self.collisions = []
+        for t in teachers:
+            self._names['username'].add(t.username.lower())
+            self._names['email'].add(t.email.lower())
+
+    def _reserve(self, field_name, name, add_suffix):
+        names = self._names[field_name]
+        if not name or name.lower() not in names:
+            names.add(name.lower())
+            return name
+        key = (field_name, name.lower())
+        suffix = self._next_suffix.get(key, 2)
+        while add_suffix(suffix).lower() in names:
+            suffix += 1
+        self._next_suffix[key] = suffix + 1
+        unique_name = add_suffix(suffix)
+        names.add(unique_name.lower())
+        return unique_name
+
+    def assign(self, teacher):
+        """
+        Changes user name and mail address of a teacher to unique values and
+        adds them to the index.
+
+        :return: True, if any name had to be changed
+        """
+        username = teacher.username
+        local_part, at, domain = teacher.email.partition('@')
+        unique_username = self._reserve('username', username, lambda n: '{}{}'.format(username, n))
+        unique_email = self._reserve('email', teacher.email, lambda n: '{}{}{}{}'.format(local_part, n, at, domain))
+        changed = False
+        for field_name, original, assigned in (('username', username, unique_username),
+                                               ('email', teacher.email, unique_email)):
+            if original != assigned:
+                setattr(teacher, field_name, assigned)
+                self.collisions.append(NameCollision(teacher, field_name, original, assigned))
+                changed = True
+        return changed
+
+
+@dataclass
+class UpdateDiff:
+    """
+    Classified result of reconciling a BBS Verwaltung export against the
+    teachers already stored in a repo.
+    """
+    # teachers marked as new in the export that are not yet in the repo
+    new: list = field(default_factory=list)
+    # teachers not marked as new, neither in the repo nor in the blacklist
+    unknown: list = field(default_factory=list)
+    # teachers from the export that are already in the repo
+    known: list = field(default_factory=list)
+    # teachers in the repo that are marked as deleted in the export
+    deleted: list = field(default_factory=list)
+    # teachers from the export that are in the blacklist
+    blacklisted: list = field(default_factory=list)
+    # changed fields per GUID: {guid: {field: (value in repo, value in export)}}
+    changed: dict = field(default_factory=dict)
+    # number of all entries read from the export
+    total: int = 0
+
+
+TeacherChange = namedtuple('TeacherChange', ['status', 'guid', 'last_name', 'first_name', 'changes'])
+
+
+class TeacherIndex:
+    """
+    Index over a list of teachers with their GUID as key. Lookups by GUID
+    are done in constant time instead of scanning the whole list.
+    """
+    # fields that are compared between repo and export
+    COMPARED_FIELDS = ('last_name', 'first_name')
+    # fields that are compared by diff()
+    DIFF_FIELDS = ('last_name', 'first_name', 'email', 'username')
+
+    def __init__(self, teachers=()):
+        self._teachers = {}
+        for t in teachers:
+            self.add(t)
+
+    def __contains__(self, guid):
+        return str(guid) in self._teachers
+
+    def __len__(self):
+        return len(self._teachers)
+
+    def get(self, guid, default=None):
+        return self._teachers.get(str(guid), default)
+
+    def add(self, teacher):
+        self._teachers[str(teacher.guid)] = teacher
+
+    def reconcile(self, imported_teachers, blacklist=()):
+        """
+        Compares all teachers from an export with the indexed teachers in a
+        single pass and classifies them. Entries from the export that are not
+        Teacher objects (e.g. rows streamed from an export file) are only
+        converted into teachers if they are not yet in the index, all of them
+        in one batch after the pass.
+
+        :param imported_teachers: iterable of teachers or rows read from an export
+        :param blacklist: container with GUIDs of blacklisted teachers
+        :return: UpdateDiff with all classified teachers
+        """
+        diff = UpdateDiff()
+        seen = set()
+        for t in imported_teachers:
+            diff.total += 1
+            guid = str(t.guid)
+            if guid in seen:
+                continue
+            seen.add(guid)
+            existing = self._teachers.get(guid)
+            if existing is None:
+                if t.deleted:
+                    continue
+                if t.added:
+                    diff.new.append(t)
+                elif guid in blacklist:
+                    diff.blacklisted.append(t)
+                else:
+                    diff.unknown.append(t)
+                continue
+            diff.known.append(existing)
+            if t.deleted and not existing.deleted:
+                diff.deleted.append(existing)
+            changes = {f: (getattr(existing, f), getattr(t, f)) for f in self.COMPARED_FIELDS
+                       if getattr(existing, f) != getattr(t, f)}
+            if changes:
+                diff.changed[guid] = changes
+        diff.new = teachers_from_rows(diff.new)
+        diff.blacklisted = teachers_from_rows(diff.blacklisted)
+        diff.unknown = teachers_from_rows(diff.unknown)
+        return diff
+
+    def diff(self, other_teachers, fields=DIFF_FIELDS):
+        """
+        Joins the indexed teachers with another list of teachers by their GUID
+        in a single pass over the other list.
+
+        :param other_teachers: iterable of teachers or rows read from an export
+        :param fields: fields compared for teachers in both lists
+        :return: list of TeacherChange objects with status 'added' for teachers
+                 only in the other list, 'removed' for teachers only in the
+                 index or marked as deleted only in the other list and
+                 'changed' for teachers with different fields
+        """
+        result = []
+        seen = set()
+        for t in other_teachers:
+            guid = str(t.guid)
+            if guid in seen:
+                continue
+            seen.add(guid)
+            existing = self._teachers.get(guid)
+            # deleted teachers are handled like an update would: unknown ones are
+            # ignored and known ones are marked as deleted
+            if existing is None:
+                if not t.deleted:
+                    result.append(TeacherChange('added', guid, t.last_name, t.first_name, {}))
+                continue
+            if t.deleted and not existing.deleted:
+                result.append(TeacherChange('removed', guid, existing.last_name, existing.first_name, {}))
+                continue
+            changes = {f: (getattr(existing, f), getattr(t, f)) for f in fields
+                       if getattr(existing, f) != getattr(t, f)}
+            if changes:
+                result.append(TeacherChange('changed', guid, existing.last_name, existing.first_name, changes))
+        for guid, t in self._teachers.items():
+            if guid not in seen:
+                result.append(TeacherChange('removed', guid, t.last_name, t.first_name, {}))
+        return result
+
+
+class GuidResolver:
+    """
+    Sorted array of GUIDs to resolve abbreviated GUIDs by binary search. Like
+    abbreviated commit hashes in git, every GUID can be abbreviated to its
+    shortest unambiguous prefix, but at least to MINIMUM_LENGTH characters.
+    """
+    MINIMUM_LENGTH = 6
+
+    def __init__(self, guids=()):
+        self._guids = sorted({str(g).lower() for g in guids})
+
+    def __len__(self):
+        return len(self._guids)
+
+    def resolve(self, prefix):
+        """Returns all GUIDs starting with the given prefix."""
+        prefix = prefix.lower()
+        start = bisect_left(self._guids, prefix)
+        end = bisect_right(self._guids, prefix + '\U0010ffff')
+        return self._guids[start:end]
+
+    def _common_prefix_length(self, index, other_index):
+        if not 0 <= other_index < len(self._guids):
+            return 0
+        a, b = self._guids[index], self._guids[other_index]
+        length = 0
+        while length < min(len(a), len(b)) and a[length] == b[length]:
+            length += 1
+        return length
+
+    def shortest_prefix_length(self, guid):
+        """Returns the length of the shortest prefix identifying the given GUID."""
+        guid = str(guid).lower()
+        index = bisect_left(self._guids, guid)
+        if index == len(self._guids) or self._guids[index] != guid:
+            return len(guid)
+        # only the neighbours in sorted order can share a longer prefix
+        common = max(self._common_prefix_length(index, index-1), self._common_prefix_length(index, index+1))
+        return min(len(guid), max(self.MINIMUM_LENGTH, common+1))
+
+    def abbreviate(self, guid):
+        return str(guid).lower()[:self.shortest_prefix_length(guid)]
+
+
+class TeacherList(list):
+    """
+    List of teachers that records all teachers that were added, removed or
+    replaced. Changes made directly to attributes of a teacher in the list
+    have to be recorded by calling mark_changed().
+    """
+    def __init__(self, teachers=()):
+        super().__init__(teachers)
+        # changed teachers by their GUID, removed teachers are stored as None
+        self.changes = {}
+        self._resolver = None
+        self._teachers_by_guid = None
+
+    @property
+    def changed(self):
+        return bool(self.changes)
+
+    @property
+    def guid_resolver(self):
+        """GuidResolver for all teachers in this list, built once until the list changes."""
+        if self._resolver is None:
+            self._resolver = GuidResolver(t.guid for t in self)
+        return self._resolver
+
+    def find(self, guid_prefix):
+        """Returns all teachers whose GUID starts with the given prefix."""
+        if self._teachers_by_guid is None:
+            self._teachers_by_guid = {str(t.guid).lower(): t for t in self}
+        return [self._teachers_by_guid[g] for g in self.guid_resolver.resolve(guid_prefix)]
+
+    def _record(self, teacher, removed=False):
+        self.changes[str(teacher.guid)] = None if removed else teacher
+        self._resolver = None
+        self._teachers_by_guid = None
+
+    def mark_changed(self, teacher):
+        self._record(teacher)
+
+    def mark_deleted(self, guids):
+        """
+        Marks all teachers with the given GUIDs as deleted in a single pass.
+
+        :return: list of teachers that were marked as deleted
+        """
+        guids = {str(g) for g in guids}
+        deleted_teachers = []
+        for i, t in enumerate(self):
+            if str(t.guid) in guids and not t.deleted:
+                self[i] = replace(t, deleted=True)
+                deleted_teachers.append(self[i])
+        return deleted_teachers
+
+    def purge(self, guids):
+        """
+        Removes all teachers with the given GUIDs in a single pass.
+
+        :return: list of removed teachers
+        """
+        guids = {str(g) for g in guids}
+        purged_teachers = [t for t in self if str(t.guid) in guids]
+        if purged_teachers:
+            super().__setitem__(slice(None), [t for t in self if str(t.guid) not in guids])
+            for t in purged_teachers:
+                self._record(t, removed=True)
+        return purged_teachers
+
+    def append(self, teacher):
+        super().append(teacher)
+        self._record(teacher)
+
+    def insert(self, index, teacher):
+        super().insert(index, teacher)
+        self._record(teacher)
+
+    def extend(self, teachers):
+        teachers = list(teachers)
+        super().extend(teachers)
+        for t in teachers:
+            self._record(t)
+
+    def __iadd__(self, teachers):
+        self.extend(teachers)
+        return self
+
+    def remove(self, teacher):
+        index = self.index(teacher)
+        self._record(self[index], removed=True)
+        super().__delitem__(index)
+
+    def pop(self, index=-1):
+        teacher = super().pop(index)
+        self._record(teacher, removed=True)
+        return teacher
+
+    def clear(self):
+        for t in self:
+            self._record(t, removed=True)
+        super().clear()
+
+    def __setitem__(self, index, value):
+        old_teachers = self[index] if isinstance(index, slice) else [self[index]]
+        new_teachers = list(value) if isinstance(index, slice) else [value]
+        super().__setitem__(index, new_teachers if isinstance(index, slice) else value)
+        for t in old_teachers:
+            self._record(t, removed=True)
+        for t in new_teachers:
+            self._record(t)
+
+    def __delitem__(self, index):
+        old_teachers = self[index] if isinstance(index, slice) else [self[index]]
+        super().__delitem__(index)
+        for t in old_teachers:
+            self._record(t, removed=True)
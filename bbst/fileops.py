@@ -1,154 +1,509 @@
 
 import os
 import csv
+import time
 import logging
-from dataclasses import asdict
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from bbst.data import Teacher, generate_mail_address, generate_username, generate_good_readable_password
+from bbst.data import (TEACHER_FIELDS, Teacher, teacher_row, generate_mail_address, generate_username,
+                       teachers_from_rows)
+from bbst.instrument import log_phase, phase, timed
+from bbst.locking import RepoLock
 
 
 logger = logging.getLogger('bbst.fileops')
 
 
+@contextmanager
+def atomic_open(file_name, newline=None, encoding='utf-8'):
+    """
+    Opens a temporary file for writing that replaces the given file only
+    after all data was written successfully. Readers of the file will either
+    see the old or the new content but never a partially written file.
+    """
+    temp_file = '{}.{}.tmp'.format(file_name, os.getpid())
+    try:
+        with open(temp_file, 'w', newline=newline, encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, file_name)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+class Blacklist:
+    """
+    Set of GUIDs of all teachers that should never be imported into a repo.
+
+    The blacklist file is only read again when its modification time has
+    changed. The modification time is checked once by refresh() when the
+    blacklist is fetched and not for every lookup, which would access the
+    file once per teacher. New entries are collected in memory and appended
+    to the file at once by calling flush().
+    """
+    def __init__(self, file_name, parent=None):
+        self.file_name = file_name
+        # blacklist of the parent repo, whose entries are also contained in this one
+        self.parent = parent
+        self._guids = set()
+        self._pending = []
+        self._mtime = None
+
+    def _modification_time(self):
+        try:
+            return os.stat(self.file_name).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        """Reads the blacklist file again if it was changed on disk."""
+        self._load()
+
+    def _load(self):
+        mtime = self._modification_time()
+        if mtime == self._mtime:
+            return
+        guids = set()
+        if mtime is not None:
+            with phase('blacklist.load') as record, open(self.file_name, 'r', encoding='utf-8') as f:
+                guids = set(f.read().split())
+                record['rows'] = len(guids)
+            logger.debug('{0} GUIDs read from blacklist file.'.format(len(guids)))
+        self._guids = guids.union(self._pending)
+        self._mtime = mtime
+
+    def __contains__(self, guid):
+        return str(guid) in self._guids or (self.parent is not None and guid in self.parent)
+
+    def __len__(self):
+        return len(self.guids())
+
+    def guids(self):
+        """Returns the GUIDs of this and all parent blacklists."""
+        return self._guids if self.parent is None else self._guids | self.parent.guids()
+
+    @property
+    def changed(self):
+        """Whether entries were added that are not yet written to the blacklist file."""
+        return bool(self._pending)
+
+    def add(self, guid):
+        if guid not in self:
+            self._guids.add(str(guid))
+            self._pending.append(str(guid))
+
+    def flush(self):
+        """Appends all added GUIDs to the blacklist file."""
+        if not self._pending:
+            return
+        # other sessions append to the same file, so appending needs the repo lock
+        with RepoLock(os.path.dirname(os.path.abspath(self.file_name))):
+            # make sure the set reflects the file before writing, so that the
+            # file after appending is recognized as already loaded
+            self._load()
+            with phase('blacklist.flush', rows=len(self._pending)), open(self.file_name, 'a+', encoding='utf-8') as f:
+                f.writelines('{}\n'.format(guid) for guid in self._pending)
+            logger.debug('{0} GUIDs appended to blacklist file.'.format(len(self._pending)))
+            self._pending = []
+            self._mtime = self._modification_time()
+
+    def discard(self):
+        """Drops all added GUIDs that were not yet written to the blacklist file."""
+        self._pending = []
+        self._mtime = None
+
+    def detach(self):
+        """
+        Writes all entries of the parent blacklist into the blacklist file, so
+        that the blacklist no longer depends on its parent.
+        """
+        if self.parent is None:
+            return
+        parent, self.parent = self.parent, None
+        for guid in sorted(parent.guids()):
+            self.add(guid)
+        self.flush()
+
+
+_blacklists = {}
+
+def get_blacklist(file_name, parent=None):
+    """
+    Returns the cached blacklist for a given file, so that every blacklist
+    file is read only once as long as it does not change on disk. Changes on
+    disk are detected only here, so the blacklist should be fetched once per
+    command.
+
+    :param parent: blacklist of the parent repo
+    """
+    key = os.path.abspath(file_name)
+    if key not in _blacklists:
+        _blacklists[key] = Blacklist(file_name)
+    _blacklists[key].parent = parent
+    _blacklists[key].refresh()
+    return _blacklists[key]
+
+def flush_blacklists(discard=False):
+    for b in _blacklists.values():
+        if discard:
+            b.discard()
+        else:
+            b.flush()
+
+
+BBSV_FIELDNAMES = ['guid', 'email', 'short_name', 'last_name', 'first_name', 'classes',
+                   'courses', 'birthday', 'initial_password', 'deleted', 'new',
+                   'teacher','groups']
+
+
+class BbsvRow:
+    """
+    Single user from a list exported by BBS Verwaltung. User name and mail
+    address are only derived from the name when they are accessed.
+    """
+    __slots__ = ('guid', 'last_name', 'first_name', 'added', 'deleted', 'is_teacher')
+
+    def __init__(self, guid, last_name, first_name, added, deleted, is_teacher):
+        self.guid = guid
+        self.last_name = last_name
+        self.first_name = first_name
+        self.added = added
+        self.deleted = deleted
+        self.is_teacher = is_teacher
+
+    @property
+    def email(self):
+        return generate_mail_address(self.last_name)
+
+    @property
+    def username(self):
+        return generate_username(self.first_name, self.last_name)
+
+    def to_teacher(self):
+        return Teacher(guid=self.guid, last_name=self.last_name, first_name=self.first_name,
+                       email=self.email, username=self.username,
+                       added=self.added, deleted=self.deleted)
+
+    def __str__(self):
+        return '<{} {}>'.format(self.first_name, self.last_name)
+
+
+def iter_bbsv_file(update_file, new=None, deleted=None, teacher=None):
+    """
+    Reads a users list exported by BBS Verwaltung row by row. Only a single
+    row is held in memory at any time.
+
+    :param update_file: file name of exported list
+    :param new: if given, only yields users whose new flag equals this value
+    :param deleted: if given, only yields users whose deleted flag equals this value
+    :param teacher: if given, only yields teachers (True) or students (False)
+    :return: generator of BbsvRow objects
+    """
+    guid_index = BBSV_FIELDNAMES.index('guid')
+    last_name_index = BBSV_FIELDNAMES.index('last_name')
+    first_name_index = BBSV_FIELDNAMES.index('first_name')
+    deleted_index = BBSV_FIELDNAMES.index('deleted')
+    new_index = BBSV_FIELDNAMES.index('new')
+    teacher_index = BBSV_FIELDNAMES.index('teacher')
+    with open(update_file, 'r', encoding='utf-8-sig') as csvfile:
+        reader = csv.reader(csvfile, delimiter=';')
+        for row in reader:
+            # skip blank lines, e.g. at the end of the file
+            if not row:
+                continue
+            if len(row) < len(BBSV_FIELDNAMES):
+                row += [''] * (len(BBSV_FIELDNAMES) - len(row))
+            was_deleted = row[deleted_index] == '-1'      # deleted = -1 / else = 0
+            is_new_user = row[new_index] == '-1'          # new = -1 / else = 0
+            is_teacher = row[teacher_index] == '-1'       # teacher = -1 / student = 0
+            if new is not None and is_new_user != new:
+                continue
+            if deleted is not None and was_deleted != deleted:
+                continue
+            if teacher is not None and is_teacher != teacher:
+                continue
+            guid = row[guid_index].replace('{','').replace('}','').lower().strip()
+            if not guid:
+                continue
+            yield BbsvRow(guid, row[last_name_index], row[first_name_index],
+                          is_new_user, was_deleted, is_teacher)
+
+@timed('read_bbsv_file', count=lambda result: len(result[2]))
 def read_bbsv_file(update_file):
     """
     Reads a teachers list exported by BBS Verwaltung. Two lists containing all
     new and deleted teachers will be returned.
     """
-    deleted_teachers = []
-    new_teachers = []
-    all_teachers = []
-    fieldnames = ['guid', 'email', 'short_name', 'last_name', 'first_name', 'classes',
-                  'courses', 'birthday', 'initial_password', 'deleted', 'new',
-                  'teacher','groups']
-    with open(update_file, 'r', encoding='utf-8-sig') as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=';', fieldnames=fieldnames)
-        for i, row in enumerate(reader):
-            guid = row['guid'].replace('{','').replace('}','').lower()
-            #email = row['email']
-            #short_name = row['short_name']
-            last_name = row['last_name']
-            first_name = row['first_name']
-            #classes = row['classes']
-            #courses = row['courses']
-            #birthday = row['birthday']
-            #initial_password = row['initial_password]
-            was_deleted = row['deleted'] == '-1'     # deleted = -1 / else = 0
-            is_new_user = row['new'] == '-1'         # new = -1 / else = 0
-            #is_teacher_or_student = row['teacher']  # teacher = -1 / student = 0
-            #group_memberships = row['groups']
-            new_teacher = Teacher(guid=guid, last_name=last_name, first_name=first_name,
-                                  email=generate_mail_address(last_name),
-                                  username=generate_username(first_name, last_name),
-                                  added=is_new_user, deleted=was_deleted)
-            if was_deleted:
-                deleted_teachers.append(new_teacher)
-            if is_new_user:
-                new_teachers.append(new_teacher)
-            all_teachers.append(new_teacher)
-        else:
-            print('{} Lehrer aus Datei eingelesen.'.format(i+1))
+    all_teachers = teachers_from_rows(iter_bbsv_file(update_file))
+    deleted_teachers = [t for t in all_teachers if t.deleted]
+    new_teachers = [t for t in all_teachers if t.added]
+    print('{} Lehrer aus Datei eingelesen.'.format(len(all_teachers)))
     return new_teachers, deleted_teachers, all_teachers
 
-def read_teacher_list(file_name):
+@timed('read_teacher_list', count=len)
+def read_teacher_list(file_name, guids=None):
+    """
+    Reads a teachers list written by write_teacher_list().
+
+    :param guids: if given, only teachers with one of these GUIDs are read
+    """
     teachers_list = []
     with open(file_name, 'r', newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
+        reader = csv.reader(csvfile)
+        header = next(reader, None)
+        if not header:
+            return teachers_list
+        # map columns of file to the fields of a teacher
+        columns = [header.index(f) for f in TEACHER_FIELDS]
+        guid_column, added_column, deleted_column = (header.index(f) for f in ('guid', 'added', 'deleted'))
         for row in reader:
+            if guids is not None and row[guid_column].strip('{}').lower() not in guids:
+                continue
             # parse strings from CSV file for boolean values
-            row['added'] = True if row['added'] == 'True' else False
-            row['deleted'] = True if row['deleted'] == 'True' else False
+            row[added_column] = row[added_column] == 'True'
+            row[deleted_column] = row[deleted_column] == 'True'
             # unify guid representation
-            row['guid'] = row['guid'].replace('{','').replace('}','').lower()
-            new_teacher = Teacher(**row)
-            teachers_list.append(new_teacher)
+            row[guid_column] = row[guid_column].replace('{','').replace('}','').lower()
+            teachers_list.append(Teacher(*[row[c] for c in columns]))
     return teachers_list
 
+@timed('write_teacher_list', count='teacher_list')
 def write_teacher_list(teacher_list, file_name):
-    fieldnames = list(asdict(Teacher()).keys())
-    with open(file_name, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        for t in teacher_list:
-            writer.writerow(asdict(t))
+    with atomic_open(file_name, newline='', encoding='utf-8') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(TEACHER_FIELDS)
+        writer.writerows(map(teacher_row, teacher_list))
+
+
+class ExportSink:
+    """
+    Base class for all export formats. While walking the teachers list once,
+    the export pipeline passes every teacher accepted by a sink to its write()
+    method. Sinks with the attribute collect set, only collect their teachers
+    and render them all at once on a worker pool by calling render(). Sinks
+    with the attribute full_roster set, always export all teachers of a repo
+    instead of only the teachers changed since the last export.
+    """
+    name = ''
+    collect = False
+    full_roster = False
+    newline = ''
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self._file = None
+
+    def accepts(self, teacher):
+        return True
+
+    def open(self):
+        if os.path.exists(self.output_file):
+            logger.warn('Output file {} already exists, will be overwritten...'.format(self.output_file))
+        self._file = open(self.output_file, 'w', newline=self.newline, encoding='utf-8')
+
+    def write(self, teacher):
+        raise NotImplementedError
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def render(self, teacher_list):
+        raise NotImplementedError
+
+
+class CsvExportSink(ExportSink):
+    delimiter = ';'
+    header = None
+
+    def open(self):
+        super().open()
+        self._writer = csv.writer(self._file, delimiter=self.delimiter)
+        if self.header:
+            self._writer.writerow(self.header)
+
+
+class MoodleSink(CsvExportSink):
+    """
+    Writes a file containing all added and deleted teachers to be imported into Moodle.
+
+    File format for importing users into Moodle:
+    cohort1;    lastname;   firstname;  username;       password;   email;                  sysrole1;       deleted
+    Kollegium;  Müller;     Kirsten;    kol.muelkirs;   12345678;   mueller@example.com;    coursecreator;  0
+    """
+    name = 'Moodle'
+    header = ('cohort1', 'lastname', 'firstname', 'username', 'password', 'email', 'sysrole1', 'deleted')
+
+    def accepts(self, teacher):
+        return teacher.added or teacher.deleted
+
+    def write(self, teacher):
+        self._writer.writerow(('Kollegium', teacher.last_name, teacher.first_name, teacher.username.lower(),
+                               teacher.password, teacher.email, 'coursecreator', '1' if teacher.deleted else '0'))
+
+
+class RadiusSink(ExportSink):
+    name = 'Radius'
+    newline = None
+    line = '{:20}\t\tCleartext-Password := "{}"\n'
+
+    def accepts(self, teacher):
+        return teacher.added
+
+    def write(self, teacher):
+        self._file.write(self.line.format(teacher.username.lower(), teacher.password))
+
+
+class WebuntisSink(CsvExportSink):
+    name = 'WebUntis'
+    # do not output header because otherwise Webuntis creates a user names "Benutzername" ;-)
+    #header = ('Name', 'Vorname', 'Benutzernamen', 'Passwort', 'Personenrolle', 'Benutzergruppe', 'Email')
+
+    def accepts(self, teacher):
+        return teacher.added or teacher.deleted
+
+    def write(self, teacher):
+        if teacher.added:
+            self._writer.writerow((teacher.last_name, teacher.first_name, teacher.username.lower(), teacher.password,
+                                   'Personenrolle', 'Benutzergruppe', teacher.email))
+        if teacher.deleted:
+            print('Bitte folgenden Lehrer manuell in Webuntis löschen: {}'.format(teacher))
+
+
+class LogodidactSink(CsvExportSink):
+    """
+    Writes a CSV file containing all teachers that are not deleted, because
+    Logodidact expects the whole roster on every import.
+    """
+    name = 'Logodidact'
+    full_roster = True
+    header = ('Klasse', 'Name', 'Firstname', 'UserID', 'Password', 'OU', 'Email')
+    DEFAULT_OU = 'ou=KOL,ou=KOL,ou=Kollegium,ou=Lehrer,ou=BBSBS,DC=SN,DC=BBSBS,DC=LOCAL'
+
+    def accepts(self, teacher):
+        return not teacher.deleted
+
+    def write(self, t):
+        self._writer.writerow(('KOL', t.last_name, t.first_name, t.username,
+                               t.password, self.DEFAULT_OU, t.email))
+
+
+class NbcSink(CsvExportSink):
+    """
+    Writes a CSV file containing all added teachers for import into the
+    NBC (Niedersächsische Bildungscloud).
+    """
+    name = 'NBC'
+    delimiter = ','
+    header = ('firstName', 'lastName', 'email', 'birthday', 'class')
+
+    def accepts(self, teacher):
+        return teacher.added
+
+    def write(self, t):
+        self._writer.writerow((t.first_name, t.last_name, t.email, '', ''))
+
+
+ExportResult = namedtuple('ExportResult', ['name', 'output_file', 'count', 'seconds', 'skipped'], defaults=(False,))
+
+
+class ExportPipeline:
+    """
+    Exports a teachers list into multiple formats while walking the list only
+    once. Every teacher is dispatched to all registered sinks accepting it.
+    Collecting sinks are rendered afterwards on a thread or process pool.
+    """
+    def __init__(self, sinks=(), max_workers=None, use_processes=False):
+        self.sinks = list(sinks)
+        self.max_workers = max_workers
+        self.use_processes = use_processes
+
+    def register(self, sink):
+        self.sinks.append(sink)
+
+    def run(self, teacher_list, dry_run=False):
+        """
+        Exports the given teachers into all registered formats. On a dry run
+        the exported teachers are only counted and no file is written.
+
+        :return: list of ExportResult objects with number of exported teachers
+                 and time spent for each format
+        """
+        if dry_run:
+            counts = [sum(1 for t in teacher_list if s.accepts(t)) for s in self.sinks]
+            return [ExportResult(s.name, s.output_file, c, 0.0) for s, c in zip(self.sinks, counts)]
+        streaming_sinks = [s for s in self.sinks if not s.collect]
+        collecting_sinks = [s for s in self.sinks if s.collect]
+        counts = {id(s): 0 for s in self.sinks}
+        seconds = {id(s): 0.0 for s in self.sinks}
+        collected = {id(s): [] for s in collecting_sinks}
+        try:
+            for s in streaming_sinks:
+                start = time.perf_counter()
+                s.open()
+                seconds[id(s)] += time.perf_counter() - start
+            for t in teacher_list:
+                for s in streaming_sinks:
+                    if s.accepts(t):
+                        start = time.perf_counter()
+                        s.write(t)
+                        seconds[id(s)] += time.perf_counter() - start
+                        counts[id(s)] += 1
+                for s in collecting_sinks:
+                    if s.accepts(t):
+                        collected[id(s)].append(t)
+        finally:
+            for s in streaming_sinks:
+                start = time.perf_counter()
+                s.close()
+                seconds[id(s)] += time.perf_counter() - start
+        # render all collecting sinks in parallel
+        pool_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        with pool_class(max_workers=self.max_workers) as pool:
+            futures = {id(s): pool.submit(_timed_render, s, collected[id(s)])
+                       for s in collecting_sinks if collected[id(s)]}
+            for key, future in futures.items():
+                seconds[key] = future.result()
+                counts[key] = len(collected[key])
+        results = [ExportResult(s.name, s.output_file, counts[id(s)], seconds[id(s)]) for s in self.sinks]
+        for r in results:
+            logger.debug('{0} teachers exported to {1} file format in {2:.3f}s.'.format(r.count, r.name, r.seconds))
+            log_phase('export.{}'.format(r.name), r.seconds, rows=r.count)
+        return results
+
+def _timed_render(sink, teacher_list):
+    start = time.perf_counter()
+    sink.render(teacher_list)
+    return time.perf_counter() - start
 
 
 def write_moodle_file(teacher_list, output_file='Moodle.csv'):
     """
     Writes a file containing all added and deleted teachers to be imported into Moodle.
-    
+
     :param teacher_list: list of teachers
     :param output_file: file name to write student list to
-    
-    File format for importing users into Moodle:
-    cohort1;    lastname;   firstname;  username;       password;   email;                  sysrole1;       deleted
-    Kollegium;  Müller;     Kirsten;    kol.muelkirs;   12345678;   mueller@example.com;    coursecreator;  0 
-    """
-    if os.path.exists(output_file):
-        logger.warn('Moodle-Datei existiert schon und wird überschrieben!')
-    # export file with all changed teachers
-    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-        count = 0
-        output_file_writer = csv.writer(csvfile, delimiter=';')
-        output_file_writer.writerow(('cohort1', 'lastname', 'firstname', 'username',
-                                     'password', 'email', 'sysrole1', 'deleted'))
-        for teacher in teacher_list:
-            if teacher.added or teacher.deleted:
-                output_file_writer.writerow(('Kollegium', teacher.last_name, teacher.first_name, teacher.username.lower(),
-                                             teacher.password, teacher.email, 'coursecreator', '1' if teacher.deleted else '0'))
-                count += 1
-        logger.debug('{0} teachers exported to Moodle file format.'.format(count))
+    """
+    ExportPipeline([MoodleSink(output_file)]).run(teacher_list)
 
 def write_radius_file(teacher_list, output_file='Radius.csv'):
-    if os.path.exists(output_file):
-        logger.warn('Output file already exists, will be overwritten...')
-    with open(output_file, 'w', encoding='utf-8') as export_file:
-        count = 0
-        line = '{:20}\t\tCleartext-Password := "{}"\n'
-        for teacher in teacher_list:
-            if teacher.added:
-                count += 1
-                formatted_line = line.format(teacher.username.lower(), teacher.password)
-                export_file.write(formatted_line)
-        logger.debug('{0} teacher exported to radius file format.'.format(count))
+    ExportPipeline([RadiusSink(output_file)]).run(teacher_list)
 
 def write_webuntis_file(teacher_list, output_file='Webuntis.csv'):
-    if os.path.exists(output_file):
-        logger.warn('Output file already exists, will be overwritten...')
-    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-        output_file_writer = csv.writer(csvfile, delimiter=';')
-        # do not output header because otherwise Webuntis creates a user names "Benutzername" ;-)
-        #output_file_writer.writerow(('Name', 'Vorname', 'Benutzernamen', 'Passwort', 'Personenrolle', 'Benutzergruppe', 'Email'))
-        for teacher in teacher_list:
-            if teacher.added:
-                output_file_writer.writerow((teacher.last_name, teacher.first_name, teacher.username.lower(), teacher.password, 'Personenrolle', 'Benutzergruppe', teacher.email))
-            if teacher.deleted:
-                print('Bitte folgenden Lehrer manuell in Webuntis löschen: {}'.format(teacher))
-
+    ExportPipeline([WebuntisSink(output_file)]).run(teacher_list)
 
 def write_logodidact_file(teacher_list, output_file='Logodidact.csv'):
-    DEFAULT_OU = 'ou=KOL,ou=KOL,ou=Kollegium,ou=Lehrer,ou=BBSBS,DC=SN,DC=BBSBS,DC=LOCAL'
-    if os.path.exists(output_file):
-        logger.warn('Output file already exists, will be overwritten...')
-    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-        output_file_writer = csv.writer(csvfile, delimiter=';')
-        output_file_writer.writerow(('Klasse', 'Name', 'Firstname', 'UserID', 'Password', 'OU', 'Email'))
-        for t in teacher_list:
-            if not t.deleted:
-                output_file_writer.writerow(('KOL', t.last_name, t.first_name, t.username,
-                                             t.password, DEFAULT_OU, t.email))
-
+    ExportPipeline([LogodidactSink(output_file)]).run(teacher_list)
 
 def write_nbc_file(teacher_list, output_file='NBC.csv'):
     """
     Writes a CSV file containing all added teachers for import into the
     NBC (Niedersächsische Bildungscloud).
     """
-    if os.path.exists(output_file):
-        logger.warn('Output file already exists, will be overwritten...')
-    with open(output_file, 'w', newline='', encoding='utf-8') as csvfile:
-        output_file_writer = csv.writer(csvfile, delimiter=',')
-        output_file_writer.writerow(('firstName', 'lastName', 'email', 'birthday', 'class'))
-        for t in teacher_list:
-            if t.added:
-                output_file_writer.writerow((t.first_name, t.last_name, t.email, '', ''))
+    ExportPipeline([NbcSink(output_file)]).run(teacher_list)
@@ -0,0 +1,96 @@
+
+import io
+import os
+import json
+import pstats
+import logging
+import cProfile
+import inspect
+from datetime import datetime
+from functools import wraps
+from time import perf_counter
+from contextlib import contextmanager
+
+
+# all timing records are logged as JSON objects to this logger
+logger = logging.getLogger('bbst.perf')
+
+# number of functions listed in the text report of a profiled command
+PROFILE_LINES = 40
+
+
+def log_phase(name, seconds, **counters):
+    """Logs a single timing record for a phase with optional counters like the number of rows."""
+    if logger.isEnabledFor(logging.DEBUG):
+        record = {'phase': name, 'seconds': round(seconds, 6)}
+        record.update(counters)
+        logger.debug(json.dumps(record, ensure_ascii=False, default=str))
+
+@contextmanager
+def phase(name, **counters):
+    """
+    Measures the time spent inside the context. The yielded dictionary can be
+    used to add counters to the record, e.g. record['rows'] = 42.
+    """
+    record = dict(counters)
+    start = perf_counter()
+    try:
+        yield record
+    finally:
+        log_phase(name, perf_counter() - start, **record)
+
+def timed(name, count=None):
+    """
+    Decorator logging the runtime of every call of a function as phase.
+
+    :param name: name of the phase
+    :param count: name of an argument whose length is logged as number of
+                  rows, or a function computing the number of rows from the
+                  result of the call
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        @wraps(func)
+        def wrapper(*args, **kwds):
+            with phase(name) as record:
+                result = func(*args, **kwds)
+                # counting must never fail a successful call, e.g. when an iterator was passed
+                try:
+                    if callable(count):
+                        record['rows'] = count(result)
+                    elif count is not None:
+                        record['rows'] = len(signature.bind(*args, **kwds).arguments[count])
+                except (TypeError, KeyError):
+                    pass
+            return result
+        return wrapper
+    return decorator
+
+@contextmanager
+def profiled(command, enabled=True, directory='.'):
+    """
+    Profiles all code inside the context with cProfile. The statistics are
+    written to a file that can be loaded with pstats or snakeviz and a text
+    report of the most expensive functions is written beside it.
+
+    :param command: name of the profiled command used in the file names
+    :param enabled: whether to profile at all
+    :param directory: directory for the profile files
+    """
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        safe_command = ''.join(c if c.isalnum() else '_' for c in command)
+        base_name = os.path.join(directory, 'profile_{}_{:%Y%m%d_%H%M%S}'.format(safe_command, datetime.now()))
+        profiler.dump_stats(base_name + '.prof')
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats('cumulative').print_stats(PROFILE_LINES)
+        with open(base_name + '.txt', 'w', encoding='utf-8') as f:
+            f.write(report.getvalue())
+        logger.debug(json.dumps({'profile': command, 'file': base_name + '.prof'}, ensure_ascii=False))
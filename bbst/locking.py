@@ -0,0 +1,205 @@
+
+import os
+import json
+import time
+import socket
+import logging
+
+from bbst.data import TeacherList, teacher_row
+
+
+logger = logging.getLogger('bbst.locking')
+
+
+LOCK_FILENAME = '.bbst.lock'
+# seconds to wait for a lock held by another user
+LOCK_TIMEOUT = 10.0
+# locks older than this are considered left behind by a crashed session
+LOCK_STALE_AFTER = 600.0
+LOCK_POLL_INTERVAL = 0.1
+
+
+class LockTimeout(Exception):
+    """Raised when a repo lock could not be acquired in time."""
+    def __init__(self, lock_file, owner):
+        super().__init__('Lock {} is held by {}'.format(lock_file, owner))
+        self.lock_file = lock_file
+        self.owner = owner
+
+
+class ConflictError(Exception):
+    """Raised when changes conflict with changes saved concurrently by another session."""
+    def __init__(self, guids):
+        super().__init__('Teachers changed concurrently: {}'.format(', '.join(guids)))
+        self.guids = guids
+
+
+# number of times every lock is held by this process, so that locks are reentrant
+_held_locks = {}
+
+
+class RepoLock:
+    """
+    Advisory lock for all writes into a repo directory. The lock file is
+    created atomically and contains owner information. Readers never take
+    the lock, because all files are replaced atomically and readers always
+    see a consistent snapshot. Locks of crashed sessions are detected by
+    their age or, on the same host, by their dead process and are broken.
+    The age of locks of other hosts is measured by the modification time of
+    the lock file, because the clocks of different hosts may differ.
+    """
+    def __init__(self, repo_path, timeout=LOCK_TIMEOUT, stale_after=LOCK_STALE_AFTER):
+        self.lock_file = os.path.abspath(os.path.join(repo_path, LOCK_FILENAME))
+        self.timeout = timeout
+        self.stale_after = stale_after
+        # difference between the clock of the share and the local clock
+        self._clock_offset = None
+
+    def _owner(self, lock_file=None):
+        try:
+            with open(lock_file or self.lock_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _share_time(self):
+        """
+        Returns the current time on the clock of the file system holding the
+        lock, which sets the modification times of all files on a share.
+        """
+        if self._clock_offset is None:
+            probe_file = '{}.{}.{}.probe'.format(self.lock_file, socket.gethostname(), os.getpid())
+            with open(probe_file, 'w'):
+                pass
+            try:
+                self._clock_offset = os.stat(probe_file).st_mtime - time.time()
+            finally:
+                os.remove(probe_file)
+        return time.time() + self._clock_offset
+
+    def _is_stale(self, owner, stat):
+        if owner is None or owner.get('host') != socket.gethostname():
+            # the lock file is being written or was damaged, or the clock of the
+            # other host may differ, so the age is measured on the clock of the share
+            return self._share_time() - stat.st_mtime > self.stale_after
+        if time.time() - owner.get('time', 0) > self.stale_after:
+            return True
+        if os.name == 'posix':
+            try:
+                os.kill(owner.get('pid'), 0)
+            except ProcessLookupError:
+                return True
+            except (PermissionError, TypeError):
+                pass
+        return False
+
+    def _try_create(self):
+        try:
+            fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'pid': os.getpid(), 'host': socket.gethostname(), 'time': time.time()}, f)
+        return True
+
+    def _break_stale_lock(self, owner, stat):
+        """
+        Removes the stale lock file with the given owner and stat result. The
+        lock file is first renamed atomically, so that a fresh lock created in
+        the meantime by another session breaking the same stale lock is
+        detected and put back instead of being removed.
+        """
+        stale_file = '{}.{}.{}.stale'.format(self.lock_file, socket.gethostname(), os.getpid())
+        try:
+            os.rename(self.lock_file, stale_file)
+        except FileNotFoundError:
+            return
+        renamed = os.stat(stale_file)
+        if ((renamed.st_ino, renamed.st_mtime_ns) != (stat.st_ino, stat.st_mtime_ns)
+                or self._owner(stale_file) != owner):
+            logger.debug('Lock {} was already broken by another session.'.format(self.lock_file))
+            try:
+                # link fails if yet another session created a lock in the meantime
+                os.link(stale_file, self.lock_file)
+            except FileExistsError:
+                logger.warning('Lock {} of another session could not be restored.'.format(self.lock_file))
+        os.remove(stale_file)
+
+    def acquire(self):
+        if _held_locks.get(self.lock_file):
+            _held_locks[self.lock_file] += 1
+            return
+        deadline = time.monotonic() + self.timeout
+        self._clock_offset = None
+        while not self._try_create():
+            try:
+                stat = os.stat(self.lock_file)
+            except FileNotFoundError:
+                continue
+            owner = self._owner()
+            if self._is_stale(owner, stat):
+                logger.warning('Breaking stale lock {} held by {}.'.format(self.lock_file, owner))
+                self._break_stale_lock(owner, stat)
+                continue
+            if time.monotonic() > deadline:
+                raise LockTimeout(self.lock_file, owner)
+            time.sleep(LOCK_POLL_INTERVAL)
+        _held_locks[self.lock_file] = 1
+
+    def release(self):
+        _held_locks[self.lock_file] -= 1
+        if _held_locks[self.lock_file]:
+            return
+        del _held_locks[self.lock_file]
+        try:
+            os.remove(self.lock_file)
+        except FileNotFoundError:
+            logger.warning('Lock {} was removed by another session.'.format(self.lock_file))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def rebase_changes(teacher_list, base_rows, current_teachers):
+    """
+    Applies the changes recorded in a TeacherList onto the teachers currently
+    stored, after another session saved its changes in the meantime. Changes
+    of different teachers are merged, changes of the same teacher conflict.
+
+    :param teacher_list: TeacherList with recorded changes
+    :param base_rows: dictionary with the rows of all teachers by GUID when the list was read
+    :param current_teachers: teachers as currently stored
+    :return: new TeacherList containing all current teachers and the recorded changes
+    """
+    current = {str(t.guid): t for t in current_teachers}
+    conflicts = []
+    for guid in teacher_list.changes:
+        base_row, current_teacher = base_rows.get(guid), current.get(guid)
+        if base_row is None:
+            # added by this session, conflicts if the other one added the same GUID
+            if current_teacher is not None:
+                conflicts.append(guid)
+        elif current_teacher is None:
+            # removed by the other session
+            if teacher_list.changes[guid] is not None:
+                conflicts.append(guid)
+        elif teacher_row(current_teacher) != base_row:
+            conflicts.append(guid)
+    if conflicts:
+        raise ConflictError(conflicts)
+    rebased = TeacherList(t for t in current_teachers if str(t.guid) not in teacher_list.changes
+                          or teacher_list.changes[str(t.guid)] is not None)
+    # the list was created with all current teachers, so replacing them records the changes
+    positions = {str(t.guid): i for i, t in enumerate(rebased)}
+    for guid, t in teacher_list.changes.items():
+        if t is None:
+            rebased.changes[guid] = None
+        elif guid in positions:
+            rebased[positions[guid]] = t
+        else:
+            rebased.append(t)
+    return rebased
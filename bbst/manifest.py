@@ -0,0 +1,87 @@
+
+import os
+import json
+import hashlib
+import logging
+from datetime import datetime
+
+from bbst.data import teacher_row
+from bbst.fileops import atomic_open
+
+
+logger = logging.getLogger('bbst.manifest')
+
+
+def teacher_hash(teacher):
+    """Returns a hash over all fields of a teacher that changes whenever any exported value changes."""
+    row = '\x1f'.join(str(v) for v in teacher_row(teacher))
+    return hashlib.sha1(row.encode('utf-8')).hexdigest()
+
+
+class ExportManifest:
+    """
+    Records the last export of a repo: a watermark with the time of the export,
+    a hash for every exported teacher and a hash over the content of every
+    export format. Based on these hashes only teachers changed since the last
+    export are exported again and unchanged output files are not rewritten.
+    """
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.watermark = None
+        self.teachers = {}
+        self.formats = {}
+        self._hashes = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.file_name, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.watermark = data['watermark']
+            self.teachers = data['teachers']
+            self.formats = data['formats']
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            logger.warning('Export manifest could not be read, exporting all teachers: {}'.format(e))
+
+    def _hash(self, teacher):
+        # hashes are computed once per teacher for all formats
+        key = id(teacher)
+        if key not in self._hashes:
+            self._hashes[key] = teacher_hash(teacher)
+        return self._hashes[key]
+
+    def changed_teachers(self, teacher_list):
+        """Returns all teachers that are new or changed since the last export."""
+        return [t for t in teacher_list if self.teachers.get(str(t.guid)) != self._hash(t)]
+
+    def format_hash(self, sink, teacher_list):
+        """
+        Returns a hash over all teachers exported by a sink. Output files
+        with the same hash as in the last export have the same content.
+        """
+        h = hashlib.sha1(sink.name.encode('utf-8'))
+        for t in teacher_list:
+            if sink.accepts(t):
+                h.update(self._hash(t).encode('ascii'))
+        return h.hexdigest()
+
+    def is_unchanged(self, sink, format_hash):
+        return self.formats.get(sink.name) == format_hash and os.path.exists(sink.output_file)
+
+    def record(self, teacher_list, format_hashes):
+        """
+        Records an export of the given teachers list. The list must contain
+        all teachers of the repo, not only the exported ones.
+
+        :param format_hashes: dictionary with the hashes of all written formats
+        """
+        self.watermark = datetime.now().isoformat(timespec='seconds')
+        self.teachers = {str(t.guid): self._hash(t) for t in teacher_list}
+        self.formats.update(format_hashes)
+
+    def save(self):
+        data = {'watermark': self.watermark, 'teachers': self.teachers, 'formats': self.formats}
+        with atomic_open(self.file_name, encoding='utf-8') as f:
+            json.dump(data, f, indent=1)
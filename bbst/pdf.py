@@ -1,13 +1,25 @@
 
+import io
+import os
 import logging
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 
-from reportlab.lib.units import cm, mm
+from reportlab.lib.units import cm, mm, inch
 from reportlab.lib.enums import TA_CENTER
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import ParagraphStyle
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 from reportlab.platypus.flowables import Image, PageBreak
+from reportlab.pdfgen.canvas import Canvas
+
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+from bbst.fileops import ExportSink
+from bbst.instrument import timed
 
 
 logger = logging.getLogger('bbst.data')
@@ -16,6 +28,22 @@ logger = logging.getLogger('bbst.data')
 PAGE_WIDTH, PAGE_HEIGHT = A4
 BORDER_HORIZONTAL = 2.0*cm
 BORDER_VERTICAL = 1.5*cm
+# number of teachers rendered by a single worker process
+SHARD_SIZE = 100
+TITLE = 'Benutzerdaten'
+AUTHOR = 'bbst - BBS Teacher Management'
+LOGO_FILE = 'logo.png'
+LOGO_HEIGHT = 5.2445*cm
+INFO_TEXT_GREETING = 'Liebe Kollegin, lieber Kollege,<br/>ihre Benutzerdaten lauten wie folgt:'
+INFO_TEXT_PARAGRAPHS = ["""Diese Zugangsdaten erlauben die Rechnernutzung in allen Räumen mit dem Logodidact-System.
+    Außerdem kann es zum Zugriff auf den Stundenplan über WebUntis und die Lernplattform Moodle genutzt werden.""",
+    """In Logodidact, Moodle und WebUntis lässt sich das Passwort ändern. Allerdings gilt jede Änderung nur für
+    das jeweilige System! Sollten Sie ihr Passwort vergessen haben, besteht bei Moodle und Webuntis die
+    Möglichkeit, sich ein neues Passwort per Mail zusenden zu lassen.""",
+    """Weitere Informationen finden Sie im Moodle-Kurs unter
+    <a color="blue" href="https://moodle.nibis.de/bbs_osb/course/view.php?id=7">https://moodle.nibis.de/bbs_osb/course/view.php?id=7</a>.
+    Bei allen weiteren Fragen können Sie sich gerne bei mir melden.""", 
+    """<br/>Viele Grüße<br/>&nbsp;&nbsp;&nbsp;&nbsp;Christian Wichmann<br/>&nbsp;&nbsp;&nbsp;&nbsp;wichmann@bbs-os-brinkstr.de"""]
 
 
 def build_footer(canvas, doc):
@@ -26,8 +54,7 @@ def build_footer(canvas, doc):
     canvas.drawRightString(PAGE_WIDTH-BORDER_HORIZONTAL, BORDER_VERTICAL, today)
     canvas.restoreState()
 
-def create_user_info_document(output_file, teacher_list):
-    logger.debug('Creating user info document...')
+def _letter_styles():
     subject_paragraph_style = ParagraphStyle(name='Normal', fontSize=12, leading=20,
                                              fontName='Times-Bold', spaceAfter=0.75*cm)
     main_paragraph_style = ParagraphStyle(name='Normal', fontSize=11, leading=18,
@@ -35,30 +62,169 @@ def create_user_info_document(output_file, teacher_list):
                                           hyphenationLang='de_DE', embeddedHyphenation=1, uriWasteReduce=0.3)
     data_paragraph_style = ParagraphStyle(name='Normal', fontSize=11, fontName='Courier',
                                           spaceAfter=0.5*cm, alignment=TA_CENTER)
+    return subject_paragraph_style, main_paragraph_style, data_paragraph_style
+
+def _user_data(t):
+    return '{}&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;{}'.format(t.username.lower(), t.password)
+
+def _build_user_info_document(output_file, teacher_list):
+    subject_paragraph_style, main_paragraph_style, data_paragraph_style = _letter_styles()
     # prepare data for document
-    title = 'Benutzerdaten'
-    author = 'bbst - BBS Teacher Management'
-    logo = Image('logo.png', width=PAGE_WIDTH-2*BORDER_HORIZONTAL, height=5.2445*cm, hAlign='CENTER')
-    info_text_greeting = 'Liebe Kollegin, lieber Kollege,<br/>ihre Benutzerdaten lauten wie folgt:'
-    info_text_paragraphs = ["""Diese Zugangsdaten erlauben die Rechnernutzung in allen Räumen mit dem Logodidact-System.
-    Außerdem kann es zum Zugriff auf den Stundenplan über WebUntis und die Lernplattform Moodle genutzt werden.""",
-    """In Logodidact, Moodle und WebUntis lässt sich das Passwort ändern. Allerdings gilt jede Änderung nur für
-    das jeweilige System! Sollten Sie ihr Passwort vergessen haben, besteht bei Moodle und Webuntis die
-    Möglichkeit, sich ein neues Passwort per Mail zusenden zu lassen.""",
-    """Weitere Informationen finden Sie im Moodle-Kurs unter
-    <a color="blue" href="https://moodle.nibis.de/bbs_osb/course/view.php?id=7">https://moodle.nibis.de/bbs_osb/course/view.php?id=7</a>.
-    Bei allen weiteren Fragen können Sie sich gerne bei mir melden.""", 
-    """<br/>Viele Grüße<br/>&nbsp;&nbsp;&nbsp;&nbsp;Christian Wichmann<br/>&nbsp;&nbsp;&nbsp;&nbsp;wichmann@bbs-os-brinkstr.de"""]
+    title = TITLE
+    author = AUTHOR
+    logo = Image(LOGO_FILE, width=PAGE_WIDTH-2*BORDER_HORIZONTAL, height=LOGO_HEIGHT, hAlign='CENTER')
     # building document
     doc = SimpleDocTemplate(output_file, author=author, title=title)
     story = []
     for t in teacher_list:
-        user_data = '{}&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;&nbsp;{}'.format(t.username.lower(), t.password)
         story.append(logo)
         story.append(Spacer(1,1.75*cm))
         story.append(Paragraph('<b>{}</b>'.format(title), subject_paragraph_style))
-        story.append(Paragraph(info_text_greeting, main_paragraph_style))
-        story.append(Paragraph(user_data, data_paragraph_style))
-        for p in info_text_paragraphs: story.append(Paragraph(p, main_paragraph_style)) 
+        story.append(Paragraph(INFO_TEXT_GREETING, main_paragraph_style))
+        story.append(Paragraph(_user_data(t), data_paragraph_style))
+        for p in INFO_TEXT_PARAGRAPHS: story.append(Paragraph(p, main_paragraph_style)) 
         story.append(PageBreak())
     doc.build(story, onFirstPage=build_footer, onLaterPages=build_footer)
+
+def _draw_flowables(canvas, flowables, x, y, width):
+    """Draws flowables top down beginning at y and returns the y position below them."""
+    for f in flowables:
+        w, h = f.wrap(width, y)
+        f.drawOn(canvas, x, y-h, _sW=width-w)
+        y -= h + f.getSpaceAfter()
+    return y
+
+def _build_user_info_template_document(output_file, teacher_list):
+    """
+    Builds the user info document by laying out the static letter once as a
+    form that is referenced by every page. The logo is embedded only once
+    and only the line with user name and password is drawn on each page.
+    """
+    subject_paragraph_style, main_paragraph_style, data_paragraph_style = _letter_styles()
+    c = Canvas(output_file, pagesize=A4)
+    c.setAuthor(AUTHOR)
+    c.setTitle(TITLE)
+    # use the same frame as SimpleDocTemplate with its default margins and paddings
+    x = inch + 6
+    width = PAGE_WIDTH - 2*inch - 12
+    top = PAGE_HEIGHT - inch - 6
+    # links are annotations of a page and can not be part of a form, so they
+    # are recorded while drawing the form and added to every page
+    links = []
+    c.linkURL = lambda url, rect, relative=0, **kw: links.append((url, c._absRect(rect, relative), kw))
+    c.beginForm('letter')
+    logo = Image(LOGO_FILE, width=PAGE_WIDTH-2*BORDER_HORIZONTAL, height=LOGO_HEIGHT, hAlign='CENTER')
+    data_top = _draw_flowables(c, [logo, Spacer(1,1.75*cm),
+                                   Paragraph('<b>{}</b>'.format(TITLE), subject_paragraph_style),
+                                   Paragraph(INFO_TEXT_GREETING, main_paragraph_style)], x, top, width)
+    _, data_height = Paragraph('&nbsp;', data_paragraph_style).wrap(width, data_top)
+    _draw_flowables(c, [Paragraph(p, main_paragraph_style) for p in INFO_TEXT_PARAGRAPHS],
+                    x, data_top - data_height - data_paragraph_style.spaceAfter, width)
+    build_footer(c, None)
+    c.endForm()
+    del c.linkURL
+    for t in teacher_list:
+        c.doForm('letter')
+        for url, rect, kw in links:
+            c.linkURL(url, rect, **kw)
+        _draw_flowables(c, [Paragraph(_user_data(t), data_paragraph_style)], x, data_top, width)
+        c.showPage()
+    c.save()
+
+def _render_shard(teacher_list, template=False):
+    output = io.BytesIO()
+    build = _build_user_info_template_document if template else _build_user_info_document
+    build(output, teacher_list)
+    return output.getvalue()
+
+@timed('create_user_info_document', count='teacher_list')
+def create_user_info_document(output_file, teacher_list, workers=1, shard_size=SHARD_SIZE, template=False):
+    """
+    Creates a document with a letter containing user name and password for
+    every given teacher.
+
+    When using more than one worker, the teachers list is split into shards
+    that are rendered in separate processes and merged afterwards. Every
+    teacher gets exactly one page, so the merged document contains the same
+    pages as a document rendered by a single process. Merging requires the
+    pypdf package, without it the document is always rendered serially.
+
+    In template mode the static letter is laid out only once and shared by
+    all pages, which is faster and creates much smaller documents.
+
+    :param output_file: file name of the document
+    :param teacher_list: list of teachers
+    :param workers: number of worker processes, None for number of CPUs
+    :param shard_size: maximum number of teachers rendered by each process
+    :param template: whether to render the static letter as template
+    """
+    logger.debug('Creating user info document...')
+    build = _build_user_info_template_document if template else _build_user_info_document
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(teacher_list) <= shard_size:
+        build(output_file, teacher_list)
+        return
+    if PdfWriter is None:
+        logger.warning('Package pypdf not found, user info document is rendered by a single process.')
+        build(output_file, teacher_list)
+        return
+    shards = [teacher_list[i:i+shard_size] for i in range(0, len(teacher_list), shard_size)]
+    logger.debug('Rendering {} shards with {} processes...'.format(len(shards), workers))
+    writer = PdfWriter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for rendered_shard in pool.map(_render_shard, shards, [template] * len(shards)):
+            writer.append(io.BytesIO(rendered_shard))
+    writer.add_metadata({'/Title': TITLE, '/Author': AUTHOR})
+    with open(output_file, 'wb') as f:
+        writer.write(f)
+
+@timed('create_user_info_documents', count='teacher_list')
+def create_user_info_documents(output_dir, teacher_list, workers=None, template=False):
+    """
+    Creates a separate user info document for every given teacher in the
+    output directory. All documents are rendered by a pool of processes.
+
+    :return: list of file names of all created documents
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    output_files = []
+    used_names = set()
+    for t in teacher_list:
+        # teachers with the same name are distinguished by their unique user name
+        # and, if that is not enough, by their GUID, so that no document is overwritten
+        file_name = '{} {} ({}).pdf'.format(t.first_name, t.last_name, t.username)
+        if file_name.lower() in used_names:
+            file_name = '{} {} ({} {}).pdf'.format(t.first_name, t.last_name, t.username, t.guid)
+        used_names.add(file_name.lower())
+        output_files.append(os.path.join(output_dir, file_name))
+    build = _build_user_info_template_document if template else _build_user_info_document
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(build, output_files, [[t] for t in teacher_list],
+                      chunksize=max(1, len(teacher_list) // (4 * (workers or os.cpu_count() or 1)))))
+    return output_files
+
+
+class UserInfoSink(ExportSink):
+    """
+    Renders the user info document for all added teachers. If per_teacher is
+    set, the output file is used as directory for a document per teacher.
+    """
+    name = 'Anschreiben'
+    collect = True
+
+    def __init__(self, output_file, workers=None, per_teacher=False, template=True):
+        super().__init__(output_file)
+        self.workers = workers
+        self.per_teacher = per_teacher
+        self.template = template
+
+    def accepts(self, teacher):
+        return teacher.added
+
+    def render(self, teacher_list):
+        if self.per_teacher:
+            create_user_info_documents(str(self.output_file), teacher_list, workers=self.workers,
+                                       template=self.template)
+        else:
+            create_user_info_document(str(self.output_file), teacher_list, workers=self.workers,
+                                      template=self.template)
@@ -0,0 +1,187 @@
+
+import os
+import sys
+import json
+import sqlite3
+import logging
+from array import array
+
+from bbst.transliteration import transliterate
+
+
+logger = logging.getLogger('bbst.search')
+
+
+# fields of a teacher that can be searched
+SEARCHED_FIELDS = ('last_name', 'first_name', 'email')
+
+
+def fold(string):
+    """
+    Folds a string for searching. Umlauts and other special characters are
+    replaced like in user names (e.g. 'ü' -> 'ue') and case is ignored.
+    """
+    return transliterate(string).casefold()
+
+def trigrams(string):
+    return {string[i:i+3] for i in range(len(string)-2)}
+
+
+class SearchIndex:
+    """
+    Inverted index mapping all trigrams of the folded names and mail addresses
+    to the teachers containing them, stored in a SQLite database next to the
+    teachers list. The postings of every trigram are stored as a compact array
+    of integer row ids. Besides the GUIDs and the folded searched fields the
+    index contains no data of the teachers, so found teachers are read from
+    the storage by their GUIDs. Changes are written incrementally without
+    rewriting the index. The fingerprint of the teachers list is stored with
+    the index to detect whether it is outdated.
+    """
+    def __init__(self, file_name=':memory:'):
+        self._connection = sqlite3.connect(str(file_name))
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS teachers (id INTEGER PRIMARY KEY, guid TEXT NOT NULL UNIQUE,
+                                                 last_name TEXT, first_name TEXT, email TEXT);
+            CREATE TABLE IF NOT EXISTS postings (trigram TEXT PRIMARY KEY, ids BLOB NOT NULL);''')
+
+    def close(self):
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM teachers').fetchone()[0]
+
+    @property
+    def fingerprint(self):
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    @classmethod
+    def build(cls, teacher_list, fingerprint=None, file_name=None):
+        """
+        Builds a new index for all given teachers. The index is written into
+        a temporary file first, so that readers never see a partial index.
+
+        :param file_name: file for the index, None for an index in memory
+        """
+        if file_name is None:
+            index = cls()
+        else:
+            temp_file = '{}.{}.tmp'.format(file_name, os.getpid())
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            index = cls(temp_file)
+        index.apply({str(t.guid): t for t in teacher_list}, fingerprint)
+        if file_name is None:
+            return index
+        index.close()
+        os.replace(temp_file, str(file_name))
+        return cls(file_name)
+
+    @staticmethod
+    def _decode(blob):
+        ids = array('I')
+        ids.frombytes(blob)
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        return ids
+
+    @staticmethod
+    def _encode(ids):
+        ids = array('I', sorted(ids))
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        return ids.tobytes()
+
+    def _postings(self, trigram):
+        row = self._connection.execute('SELECT ids FROM postings WHERE trigram = ?', (trigram,)).fetchone()
+        return self._decode(row[0]) if row else array('I')
+
+    def apply(self, changes, fingerprint=None):
+        """
+        Applies changes recorded by a TeacherList to the index in a single
+        transaction together with the new fingerprint of the teachers list.
+        The postings of every affected trigram are written only once.
+        """
+        postings = {}
+        def ids(trigram):
+            if trigram not in postings:
+                postings[trigram] = set(self._postings(trigram))
+            return postings[trigram]
+        with self._connection:
+            for guid, t in changes.items():
+                row = self._connection.execute('SELECT id, last_name, first_name, email FROM teachers WHERE guid = ?',
+                                               (str(guid),)).fetchone()
+                if row is not None:
+                    row_id, *fields = row
+                    for trigram in {tg for value in fields for tg in trigrams(value)}:
+                        ids(trigram).discard(row_id)
+                    self._connection.execute('DELETE FROM teachers WHERE id = ?', (row_id,))
+                if t is None:
+                    continue
+                fields = [fold(getattr(t, f)) for f in SEARCHED_FIELDS]
+                row_id = self._connection.execute('INSERT INTO teachers (guid, last_name, first_name, email) '
+                                                  'VALUES (?, ?, ?, ?)', [str(guid)] + fields).lastrowid
+                for trigram in {tg for value in fields for tg in trigrams(value)}:
+                    ids(trigram).add(row_id)
+            self._connection.executemany('INSERT OR REPLACE INTO postings VALUES (?, ?)',
+                                         ((tg, self._encode(i)) for tg, i in postings.items() if i))
+            self._connection.executemany('DELETE FROM postings WHERE trigram = ?',
+                                         ((tg,) for tg, i in postings.items() if not i))
+            self._connection.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)",
+                                     (json.dumps(fingerprint),))
+
+    def search(self, query):
+        """
+        Searches all teachers whose first name, last name or mail address
+        contain the given query. Results are ranked by whether a field equals
+        the query, starts with it or only contains it.
+
+        :return: list of GUIDs of all found teachers
+        """
+        query = fold(query)
+        if not query:
+            return []
+        columns = 'SELECT guid, last_name, first_name, email FROM teachers '
+        if len(query) >= 3:
+            # start with the rarest trigram to keep the intersection small
+            postings = sorted((self._postings(t) for t in trigrams(query)), key=len)
+            candidates = sorted(set(postings[0]).intersection(*postings[1:]))
+            rows = []
+            # stay below the limit of SQLite for the number of parameters
+            for i in range(0, len(candidates), 500):
+                chunk = candidates[i:i+500]
+                rows.extend(self._connection.execute(
+                    columns + 'WHERE id IN ({})'.format(', '.join('?' * len(chunk))), chunk))
+        else:
+            rows = self._connection.execute(
+                columns + 'WHERE instr(last_name, ?) OR instr(first_name, ?) OR instr(email, ?)', [query] * 3)
+        results = []
+        for guid, *folded_fields in rows:
+            score = 0
+            for value in folded_fields:
+                if value == query:
+                    score = max(score, 3)
+                elif value.startswith(query):
+                    score = max(score, 2)
+                elif query in value:
+                    score = max(score, 1)
+            if score:
+                results.append((-score, folded_fields, guid))
+        results.sort()
+        return [r[-1] for r in results]
+
+    @classmethod
+    def load(cls, file_name):
+        """Opens an index file, returns None if the file does not exist or is damaged."""
+        if not os.path.exists(str(file_name)):
+            return None
+        index = cls(file_name)
+        try:
+            index.fingerprint
+        except sqlite3.DatabaseError as e:
+            logger.warning('Search index could not be read: {}'.format(e))
+            index.close()
+            return None
+        return index
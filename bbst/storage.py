@@ -0,0 +1,317 @@
+
+import os
+import sqlite3
+import logging
+from contextlib import closing
+
+from bbst.data import TEACHER_FIELDS, Teacher, teacher_row
+from bbst.fileops import atomic_open, read_teacher_list, write_teacher_list
+
+
+logger = logging.getLogger('bbst.storage')
+
+
+OVERLAY_FILENAME = 'teacher_overlay.csv'
+TOMBSTONES_FILENAME = 'teacher_tombstones.txt'
+# suffix of the file beside every storage file counting how often it was written
+GENERATION_SUFFIX = '.generation'
+
+
+def file_fingerprint(file_name):
+    """Returns modification time and size of a file to detect changes."""
+    try:
+        stat = os.stat(file_name)
+        return [stat.st_mtime_ns, stat.st_size]
+    except FileNotFoundError:
+        return None
+
+def read_generation(file_name):
+    """Returns the generation counter stored beside a file, 0 if there is none."""
+    try:
+        with open(file_name + GENERATION_SUFFIX, 'r', encoding='utf-8') as f:
+            return int(f.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+    except ValueError:
+        logger.warning('Generation counter of {} could not be read.'.format(file_name))
+        return 0
+
+def increment_generation(file_name):
+    """
+    Increments the generation counter of a file after it was written. Writers
+    must hold the repo lock, so that no increment is lost.
+    """
+    with atomic_open(file_name + GENERATION_SUFFIX, encoding='utf-8') as f:
+        f.write(str(read_generation(file_name) + 1))
+
+
+class TeacherStorage:
+    """
+    Base class for all backends storing the teachers list of a repo. Besides
+    reading and writing the whole list, single teachers can be added, updated
+    and removed by their GUID.
+
+    Every write increments a generation counter, because modification time
+    and size of a file do not reliably change on shared drives with coarse
+    timestamps. The fingerprint of a storage contains the counter, so that
+    changes by other sessions are always detected.
+    """
+    name = ''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def exists(self):
+        return os.path.exists(self.file_name)
+
+    def fingerprint(self):
+        """Returns generation, modification time and size of the storage to detect changes."""
+        return [read_generation(self.file_name), file_fingerprint(self.file_name)]
+
+    def read_all(self):
+        raise NotImplementedError
+
+    def write_all(self, teacher_list):
+        raise NotImplementedError
+
+    def save(self, teacher_list):
+        """
+        Writes all changes recorded in a TeacherList into the storage. Lists
+        without any changes are not written at all.
+        """
+        if not teacher_list.changed:
+            return
+        self.write_all(teacher_list)
+        teacher_list.changes.clear()
+
+    def get(self, guid):
+        for t in self.read_all():
+            if t.guid == str(guid):
+                return t
+        return None
+
+    def get_many(self, guids):
+        """Returns the teachers with the given GUIDs in the same order, unknown GUIDs are skipped."""
+        wanted = {str(g) for g in guids}
+        return self._ordered(guids, (t for t in self.read_all() if t.guid in wanted))
+
+    @staticmethod
+    def _ordered(guids, teachers):
+        found = {str(t.guid): t for t in teachers}
+        return [found[str(g)] for g in guids if str(g) in found]
+
+    def add(self, teacher):
+        teacher_list = self.read_all() if self.exists() else []
+        teacher_list.append(teacher)
+        self.write_all(teacher_list)
+
+    def update(self, teacher):
+        teacher_list = [teacher if t.guid == str(teacher.guid) else t for t in self.read_all()]
+        self.write_all(teacher_list)
+
+    def remove(self, guid):
+        teacher_list = [t for t in self.read_all() if t.guid != str(guid)]
+        self.write_all(teacher_list)
+
+    def import_csv(self, file_name):
+        """Replaces all stored teachers with the teachers from a given CSV file."""
+        self.write_all(read_teacher_list(file_name))
+
+    def export_csv(self, file_name):
+        """Writes all stored teachers into a CSV file."""
+        write_teacher_list(self.read_all(), file_name)
+
+
+class CsvStorage(TeacherStorage):
+    """
+    Stores all teachers in a single CSV file. Every change reads and writes
+    the whole file.
+    """
+    name = 'csv'
+
+    def read_all(self):
+        return read_teacher_list(self.file_name)
+
+    def write_all(self, teacher_list):
+        write_teacher_list(teacher_list, self.file_name)
+        increment_generation(self.file_name)
+
+    def get_many(self, guids):
+        # only the rows of the wanted teachers are converted while reading the file
+        return self._ordered(guids, read_teacher_list(self.file_name, guids={str(g) for g in guids}))
+
+
+class SqliteStorage(TeacherStorage):
+    """
+    Stores all teachers in a SQLite database with an index on their GUID, so
+    that single teachers can be added, updated and removed without rewriting
+    the whole repo.
+    """
+    name = 'sqlite'
+
+    def _connect(self):
+        connection = sqlite3.connect(str(self.file_name))
+        connection.execute('''CREATE TABLE IF NOT EXISTS teachers (
+                                  guid TEXT NOT NULL UNIQUE, last_name TEXT, first_name TEXT,
+                                  email TEXT, username TEXT, password TEXT,
+                                  added INTEGER, deleted INTEGER)''')
+        return connection
+
+    @staticmethod
+    def _to_row(t):
+        return (str(t.guid), t.last_name, t.first_name, t.email, t.username, t.password,
+                int(t.added), int(t.deleted))
+
+    @staticmethod
+    def _from_row(row):
+        guid, last_name, first_name, email, username, password, added, deleted = row
+        return Teacher(guid=guid, last_name=last_name, first_name=first_name, email=email,
+                       username=username, password=password, added=bool(added), deleted=bool(deleted))
+
+    def read_all(self):
+        with closing(self._connect()) as connection:
+            rows = connection.execute('SELECT {} FROM teachers ORDER BY rowid'.format(', '.join(TEACHER_FIELDS)))
+            return [self._from_row(row) for row in rows]
+
+    def write_all(self, teacher_list):
+        with closing(self._connect()) as connection, connection:
+            connection.execute('DELETE FROM teachers')
+            connection.executemany('INSERT INTO teachers VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (self._to_row(t) for t in teacher_list))
+        increment_generation(self.file_name)
+
+    def save(self, teacher_list):
+        if not teacher_list.changed:
+            return
+        with closing(self._connect()) as connection, connection:
+            for guid, t in teacher_list.changes.items():
+                if t is None:
+                    connection.execute('DELETE FROM teachers WHERE guid = ?', (guid,))
+                elif not self._update_row(connection, t):
+                    connection.execute('INSERT INTO teachers VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self._to_row(t))
+        increment_generation(self.file_name)
+        logger.debug('{0} changed teachers saved to database.'.format(len(teacher_list.changes)))
+        teacher_list.changes.clear()
+
+    def get(self, guid):
+        with closing(self._connect()) as connection:
+            row = connection.execute('SELECT {} FROM teachers WHERE guid = ?'.format(', '.join(TEACHER_FIELDS)),
+                                     (str(guid),)).fetchone()
+            return self._from_row(row) if row else None
+
+    def get_many(self, guids):
+        guids = [str(g) for g in guids]
+        teachers = []
+        with closing(self._connect()) as connection:
+            # stay below the limit of SQLite for the number of parameters
+            for i in range(0, len(guids), 500):
+                chunk = guids[i:i+500]
+                rows = connection.execute('SELECT {} FROM teachers WHERE guid IN ({})'.format(
+                                          ', '.join(TEACHER_FIELDS), ', '.join('?' * len(chunk))), chunk)
+                teachers.extend(self._from_row(row) for row in rows)
+        return self._ordered(guids, teachers)
+
+    def add(self, teacher):
+        with closing(self._connect()) as connection, connection:
+            connection.execute('INSERT INTO teachers VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self._to_row(teacher))
+        increment_generation(self.file_name)
+
+    def _update_row(self, connection, teacher):
+        row = self._to_row(teacher)
+        cursor = connection.execute('''UPDATE teachers SET last_name = ?, first_name = ?, email = ?, username = ?,
+                                       password = ?, added = ?, deleted = ? WHERE guid = ?''', row[1:] + row[:1])
+        return cursor.rowcount > 0
+
+    def update(self, teacher):
+        with closing(self._connect()) as connection, connection:
+            self._update_row(connection, teacher)
+        increment_generation(self.file_name)
+
+    def remove(self, guid):
+        with closing(self._connect()) as connection, connection:
+            connection.execute('DELETE FROM teachers WHERE guid = ?', (str(guid),))
+        increment_generation(self.file_name)
+
+
+class OverlayStorage(TeacherStorage):
+    """
+    Stores only the differences of a repo to its parent repo: all teachers
+    added or changed in this repo and tombstones for all teachers of the
+    parent that were removed in this repo. The parent storage is only read,
+    so a new repo can be based on an existing repo in constant time and
+    needs space only for its own changes.
+    """
+    name = 'overlay'
+
+    def __init__(self, repo_path, parent):
+        """
+        :param repo_path: path to the repo directory
+        :param parent: storage of the parent repo
+        """
+        super().__init__(os.path.join(repo_path, OVERLAY_FILENAME))
+        self.tombstones_file = os.path.join(repo_path, TOMBSTONES_FILENAME)
+        self.parent = parent
+
+    def exists(self):
+        return self.parent.exists() or os.path.exists(self.file_name)
+
+    def fingerprint(self):
+        return [self.parent.fingerprint(), read_generation(self.file_name),
+                file_fingerprint(self.file_name), file_fingerprint(self.tombstones_file)]
+
+    def _parent_teachers(self):
+        teachers = self.parent.read_all() if self.parent.exists() else []
+        for t in teachers:
+            # teachers were added in the parent repo, not in this one
+            t.added = False
+        return teachers
+
+    def _read_tombstones(self):
+        try:
+            with open(self.tombstones_file, 'r', encoding='utf-8') as f:
+                return set(f.read().split())
+        except FileNotFoundError:
+            return set()
+
+    def read_all(self):
+        overlay = read_teacher_list(self.file_name) if os.path.exists(self.file_name) else []
+        tombstones = self._read_tombstones()
+        changed = {str(t.guid): t for t in overlay}
+        teachers = [changed.pop(str(t.guid), t) for t in self._parent_teachers() if str(t.guid) not in tombstones]
+        # teachers not found in the parent were added in this repo
+        teachers.extend(changed.values())
+        return teachers
+
+    def write_all(self, teacher_list):
+        # teachers compare equal by their GUID only, so whole rows are compared
+        parent = {str(t.guid): teacher_row(t) for t in self._parent_teachers()}
+        guids = {str(t.guid) for t in teacher_list}
+        overlay = [t for t in teacher_list if parent.get(str(t.guid)) != teacher_row(t)]
+        tombstones = [guid for guid in parent if guid not in guids]
+        write_teacher_list(overlay, self.file_name)
+        with atomic_open(self.tombstones_file, encoding='utf-8') as f:
+            f.writelines('{}\n'.format(guid) for guid in tombstones)
+        increment_generation(self.file_name)
+        logger.debug('{0} changed and {1} removed teachers written to overlay.'.format(len(overlay), len(tombstones)))
+
+    def remove_files(self):
+        """Removes the overlay after the repo was materialized into a storage of its own."""
+        for file_name in (self.file_name, self.tombstones_file, self.file_name + GENERATION_SUFFIX):
+            if os.path.exists(file_name):
+                os.remove(file_name)
+
+
+STORAGE_BACKENDS = {CsvStorage.name: (CsvStorage, 'teacher_list.csv'),
+                    SqliteStorage.name: (SqliteStorage, 'teacher_list.sqlite')}
+
+def open_storage(repo_path, backend='csv'):
+    """
+    Returns the storage for the teachers list in a given repo directory.
+
+    :param repo_path: path to the repo directory
+    :param backend: name of the storage backend, either 'csv' or 'sqlite'
+    """
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError('Unknown storage backend: {}'.format(backend))
+    storage_class, file_name = STORAGE_BACKENDS[backend]
+    return storage_class(os.path.join(repo_path, file_name))
@@ -0,0 +1,55 @@
+
+from itertools import chain, islice
+
+
+# number of rows used to compute the column widths
+SAMPLE_SIZE = 1000
+ELLIPSIS = '…'
+
+
+def column_widths(rows, headers, sample_size=SAMPLE_SIZE):
+    """
+    Computes the widths of all columns from the headers and a sample of the
+    first rows, so that a table can be printed before all rows are known.
+
+    :param rows: iterator of rows, the sampled rows are consumed
+    :return: list of column widths and list of the sampled rows
+    """
+    sample = [tuple(str(v) for v in row) for row in islice(rows, sample_size)]
+    widths = [len(h) for h in headers]
+    for row in sample:
+        widths = [max(w, len(v)) for w, v in zip(widths, row)]
+    return widths, sample
+
+def _format_row(values, widths):
+    cells = []
+    for v, w in zip(values, widths):
+        # values longer than all sampled values are cut off
+        if len(v) > w:
+            v = v[:w-1] + ELLIPSIS
+        cells.append(v.ljust(w))
+    return '| ' + ' | '.join(cells) + ' |'
+
+def iter_grid_table(rows, headers, sample_size=SAMPLE_SIZE):
+    """
+    Yields the lines of a table in the grid format of tabulate. Rows are
+    formatted one by one, so the first lines are available immediately even
+    for very long tables.
+
+    :param rows: iterable of rows with one value per column
+    :param headers: names of all columns
+    :param sample_size: number of rows used to compute the column widths
+    """
+    rows = iter(rows)
+    widths, sample = column_widths(rows, headers, sample_size)
+    separator = '+' + '+'.join('-' * (w + 2) for w in widths) + '+'
+    yield separator
+    yield _format_row(headers, widths)
+    yield separator.replace('-', '=')
+    remaining = (tuple(str(v) for v in row) for row in rows)
+    for i, row in enumerate(chain(sample, remaining)):
+        if i:
+            yield separator
+        yield _format_row(row, widths)
+    if sample:
+        yield separator
@@ -0,0 +1,96 @@
+
+import unicodedata
+from functools import lru_cache
+
+
+### map translating all illegal characters into legal (ascii) characters
+char_map = {'ä': 'ae',
+            'à': 'a',
+            'á': 'a',
+            'â': 'a',
+            'ã': 'a',
+            'Ä': 'Ae',
+            'À': 'A',
+            'Á': 'A',
+            'Â': 'A',
+            'Ã': 'A',
+            'è': 'e',
+            'é': 'e',
+            'ê': 'e',
+            'È': 'E',
+            'É': 'E',
+            'Ê': 'E',
+            'ö': 'oe',
+            'ò': 'o',
+            'ó': 'o',
+            'ô': 'o',
+            'õ': 'o',
+            'Ö': 'Oe',
+            'Ò': 'O',
+            'Ó': 'O',
+            'Ô': 'O',
+            'Õ': 'O',
+            'ü': 'ue',
+            'ù': 'u',
+            'ú': 'u',
+            'û': 'u',
+            'Ü': 'Ue',
+            'Ù': 'U',
+            'Ú': 'U',
+            'Û': 'U',
+            'í': 'i',
+            'ß': 'ss',
+            'Ç': 'C',
+            'ç': 'c',
+            'č': 'c',
+            'ć': 'c',
+            '´': '',
+            '-': '',
+            ' ': '',
+            'š': 's'}
+
+### map for characters that can not be decomposed into ascii characters
+extra_char_map = {'æ': 'ae',
+                  'Æ': 'Ae',
+                  'ø': 'oe',
+                  'Ø': 'Oe',
+                  'å': 'aa',
+                  'Å': 'Aa',
+                  'œ': 'oe',
+                  'Œ': 'Oe',
+                  'ł': 'l',
+                  'Ł': 'L',
+                  'đ': 'd',
+                  'Đ': 'D',
+                  'ð': 'd',
+                  'Ð': 'D',
+                  'þ': 'th',
+                  'Þ': 'Th',
+                  'ı': 'i'}
+
+_translation_table = str.maketrans({**extra_char_map, **char_map})
+
+
+@lru_cache(maxsize=8192)
+def transliterate(string):
+    """
+    Transliterates a string into ascii characters. All characters in the char
+    maps are replaced by a precompiled translation table. Remaining non-ascii
+    characters are decomposed and their diacritical marks are removed (e.g.
+    'ş' -> 's'). Characters without ascii representation are dropped.
+    """
+    result = string.translate(_translation_table)
+    if result.isascii():
+        return result
+    decomposed = unicodedata.normalize('NFKD', result)
+    return ''.join(char for char in decomposed if char.isascii())
+
+def transliterate_all(strings):
+    """Transliterates all given strings, every distinct string is only processed once."""
+    strings = list(strings)
+    transliterated = {s: transliterate(s) for s in set(strings)}
+    return [transliterated[s] for s in strings]
+
+def replace_illegal_characters(string):
+    """Replaces illegal characters from a given string with values from char map."""
+    return transliterate(string)
@@ -6,30 +6,31 @@ bbst - BBS Teacher Management
 @author: Christian Wichmann
 """
 
+import os
 import sys
+import csv
+import json
 import shutil
 import logging
 import logging.handlers
+import configparser
 from pathlib import Path
 from datetime import datetime
 from collections import Counter
-from contextlib import contextmanager
-from dataclasses import asdict, astuple, replace
+from contextlib import contextmanager, redirect_stdout
+from operator import attrgetter
+from dataclasses import replace
 
 import click
-from tabulate import tabulate
-from prompt_toolkit import PromptSession, prompt
-from prompt_toolkit.styles import Style
-from prompt_toolkit.completion import Completer, Completion, WordCompleter, PathCompleter, merge_completers
-from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
-from prompt_toolkit.application import run_in_terminal
-from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.shortcuts import message_dialog, yes_no_dialog, input_dialog, ProgressBar
-from prompt_toolkit.history import FileHistory
 
-from bbst.data import Teacher, generate_mail_address, generate_username
-from bbst.fileops import read_bbsv_file, read_teacher_list, write_teacher_list, write_moodle_file, write_radius_file, write_webuntis_file, write_logodidact_file, write_nbc_file
-from bbst.pdf import create_user_info_document
+from bbst.data import PASSWORD_LENGTH, AccountNameIndex, PasswordPolicy, password_pool, TEACHER_FIELDS, Teacher, TeacherIndex, TeacherList, teacher_row, generate_mail_address, generate_username
+from bbst.fileops import get_blacklist, flush_blacklists, iter_bbsv_file, ExportPipeline, ExportResult, MoodleSink, LogodidactSink, NbcSink, RadiusSink, WebuntisSink
+from bbst.instrument import phase, profiled
+from bbst.locking import ConflictError, LockTimeout, RepoLock, rebase_changes
+from bbst.manifest import ExportManifest
+from bbst.search import SearchIndex
+from bbst.table import iter_grid_table
+from bbst.storage import STORAGE_BACKENDS, CsvStorage, OverlayStorage, open_storage
 
 
 logger = logging.getLogger('bbst')
@@ -37,10 +38,12 @@ logger = logging.getLogger('bbst')
 
 LOG_FILENAME = 'bbst.log'
 REPO_TOKEN = '.bbst'
-TEACHER_LIST_FILENAME = 'teacher_list.csv'
 BLACKLIST_FILENAME = 'blacklist.txt'
+SEARCH_INDEX_FILENAME = 'search_index.sqlite'
+EXPORT_MANIFEST_FILENAME = 'export_manifest.json'
 HISTORY_FILE = '.bbst-history-file'
 USER_INFO_FILENAME = 'Anschreiben.pdf'
+USER_INFO_DIRNAME = 'Anschreiben'
 MOODLE_FILENAME = 'Moodle.csv'
 WEBUNTIS_FILENAME = 'Webuntis.csv'
 RADIUS_FILENAME = 'Radius.csv'
@@ -51,82 +54,383 @@ BASE_PATH = Path().cwd()
 # TODO: Eliminate global variables!
 current_path = BASE_PATH
 current_repo = ''
+# if set, no changes are written to disk
+dry_run = False
+# if set, every command is profiled with cProfile
+profile_commands = False
 
 
-# Asyncio bug workaround
-# https://github.com/prompt-toolkit/python-prompt-toolkit/issues/1023
-import asyncio
-import selectors
-selector = selectors.SelectSelector()
-loop = asyncio.SelectorEventLoop(selector)
-asyncio.set_event_loop(loop)
-# End workaround
+# Heavy dependencies like ReportLab, tabulate and prompt_toolkit are imported
+# only inside the commands needing them to keep the start of the tool fast.
+
+def install_event_loop():
+    """
+    Asyncio bug workaround, only needed for the interactive prompt.
+    https://github.com/prompt-toolkit/python-prompt-toolkit/issues/1023
+    """
+    import asyncio
+    import selectors
+    selector = selectors.SelectSelector()
+    loop = asyncio.SelectorEventLoop(selector)
+    asyncio.set_event_loop(loop)
 
 
 ################################  Helper ######################################
 
+def prompt(*args, **kwds):
+    from prompt_toolkit import prompt as prompt_toolkit_prompt
+    return prompt_toolkit_prompt(*args, **kwds)
+
+def read_repo_config(repo_path):
+    """Reads the configuration of a repo from its token file."""
+    config = configparser.ConfigParser()
+    config.read_dict({'repo': {'storage': CsvStorage.name, 'password_length': PASSWORD_LENGTH}})
+    config.read(Path(repo_path) / REPO_TOKEN, encoding='utf-8')
+    return config
+
+def write_repo_config(repo_path, config):
+    with open(Path(repo_path) / REPO_TOKEN, 'w', encoding='utf-8') as f:
+        config.write(f)
+    # the parents of all repos are cached by the registries of all sessions until
+    # the base directory changes, so its modification time is updated
+    repo_registry.invalidate()
+    try:
+        os.utime(Path(repo_path).parent)
+    except OSError as e:
+        logger.warning('Modification time of base directory could not be updated: {}'.format(e))
+
+
+class MissingParentRepo(Exception):
+    """Raised when a repo is based on a parent repo that does not exist anymore."""
+    def __init__(self, repo, parent):
+        super().__init__('Parent {} of repo {} not found'.format(parent, repo))
+        self.repo = repo
+        self.parent = parent
+
+
+def parent_repo(repo_path, allow_missing=False):
+    """
+    Returns the name of the repo the given repo is based on or None.
+
+    :param allow_missing: whether to return the name of a missing parent
+                          instead of raising MissingParentRepo
+    """
+    parent = read_repo_config(repo_path)['repo'].get('parent')
+    if parent and not allow_missing and BASE_PATH / parent not in repo_registry:
+        raise MissingParentRepo(Path(repo_path).name, parent)
+    return parent
+
+def repo_storage(repo_path=None, allow_missing_parent=False):
+    """
+    Returns the storage backend configured for a given or the current repo.
+    Repos based on a parent repo store only their changes as overlay.
+    """
+    repo_path = current_path if repo_path is None else BASE_PATH / repo_path
+    parent = parent_repo(repo_path, allow_missing_parent)
+    if parent:
+        return OverlayStorage(repo_path, repo_storage(parent, allow_missing_parent))
+    return open_storage(repo_path, read_repo_config(repo_path)['repo']['storage'])
+
+def repo_blacklist(repo_path=None, allow_missing_parent=False):
+    """Returns the blacklist of a given or the current repo including the entries of its parents."""
+    repo_path = current_path if repo_path is None else BASE_PATH / repo_path
+    parent = parent_repo(repo_path, allow_missing_parent)
+    return get_blacklist(repo_path / BLACKLIST_FILENAME,
+                         parent=repo_blacklist(parent, allow_missing_parent) if parent else None)
+
+def repo_ancestors(repo_path):
+    """Returns the paths of all repos the given repo is based on."""
+    ancestors = []
+    parent = read_repo_config(repo_path)['repo'].get('parent')
+    while parent and BASE_PATH / parent not in ancestors:
+        ancestors.append(BASE_PATH / parent)
+        parent = read_repo_config(BASE_PATH / parent)['repo'].get('parent')
+    return ancestors
+
+def materialize_repo(repo_path, allow_missing_parent=False):
+    """
+    Copies the teachers list and blacklist of the parent into a repo, so that
+    the repo no longer depends on its parent.
+
+    :param allow_missing_parent: whether to keep only the changes of the repo
+                                 itself if its parent does not exist anymore
+    """
+    with RepoLock(repo_path):
+        config = read_repo_config(repo_path)
+        if not config['repo'].get('parent'):
+            return
+        overlay = repo_storage(repo_path, allow_missing_parent)
+        teachers = overlay.read_all()
+        repo_blacklist(repo_path, allow_missing_parent).detach()
+        open_storage(repo_path, config['repo']['storage']).write_all(teachers)
+        del config['repo']['parent']
+        write_repo_config(repo_path, config)
+        overlay.remove_files()
+    logger.debug('Repo {} materialized with {} teachers.'.format(repo_path, len(teachers)))
+
+def materialize_children(repo_path):
+    """
+    Materializes all repos based on the given repo before it is changed, so
+    that changes are not visible in repos derived from an earlier state.
+    """
+    if dry_run:
+        return
+    for r in repo_registry.children(repo_path):
+        materialize_repo(r)
+        print('Repo {} übernimmt alle Daten aus Repo {}, bevor es geändert wird.'.format(r.name, Path(repo_path).name))
+
 @contextmanager
-def teacher_list(*args, **kwds):
+def teacher_list(*args, readonly=False, **kwds):
+    """
+    Yields the teachers list of the current repo. Changes to the list are
+    written back at the end, unless the list is opened read-only.
+    """
     if 'filename' in kwds:
-        teacher_list_file = kwds['filename']
+        storage = CsvStorage(kwds['filename'])
     else:
-        teacher_list_file = current_path / TEACHER_LIST_FILENAME
-    if not teacher_list_file.exists():
+        storage = repo_storage()
+    if not storage.exists():
         print('Fehler: Aktuelles Repo enthält noch keine Listendatei.')
-        yield []
+        yield TeacherList()
     else:
+        # the list is read without lock, changes by other sessions are detected when saving
+        fingerprint = storage.fingerprint()
+        l = TeacherList(storage.read_all())
+        base_rows = {} if readonly else {str(t.guid): teacher_row(t) for t in l}
         try:
-            l = read_teacher_list(teacher_list_file)
             yield l
         finally:
-            write_teacher_list(l, teacher_list_file)
+            if not readonly and dry_run:
+                if l.changed:
+                    print('Testmodus: {} Änderungen werden nicht gespeichert.'.format(len(l.changes)))
+            elif not readonly and l.changed:
+                save_teacher_list(storage, l, fingerprint, base_rows)
+
+def save_teacher_list(storage, l, fingerprint, base_rows):
+    """
+    Saves all changes of a teachers list while holding the lock of the current
+    repo. If another session saved the list after it was read, the changes
+    are rebased onto the stored list or rejected if they affect the same
+    teachers.
+
+    :param fingerprint: fingerprint of the storage when the list was read
+    :param base_rows: rows of all teachers by GUID when the list was read
+    """
+    with RepoLock(current_path):
+        if storage.fingerprint() != fingerprint:
+            logger.debug('Teachers list was changed by another session, rebasing {} changes.'.format(len(l.changes)))
+            l = rebase_changes(l, base_rows, storage.read_all())
+        materialize_children(current_path)
+        with search_index_updates(storage) as changes, phase('storage.save', backend=storage.name, rows=len(l.changes)):
+            changes.update(l.changes)
+            storage.save(l)
+
+@contextmanager
+def search_index_updates(storage):
+    """
+    Yields a dictionary to record all changes made to the storage inside the
+    context and applies them to the search index of the current repo. If the
+    index was already outdated, it is deleted and rebuilt by the next search.
+    """
+    index_file = current_path / SEARCH_INDEX_FILENAME
+    fingerprint = storage.fingerprint()
+    changes = {}
+    yield changes
+    if not changes or not index_file.exists():
+        return
+    index = SearchIndex.load(index_file)
+    if index is None or index.fingerprint != fingerprint:
+        if index is not None:
+            index.close()
+        index_file.unlink()
+        return
+    index.apply(changes, storage.fingerprint())
+    index.close()
+
+def search_index(storage):
+    """
+    Returns the search index of the current repo and rebuilds it if outdated.
+    In test mode an outdated index is only rebuilt in memory.
+    """
+    index_file = current_path / SEARCH_INDEX_FILENAME
+    # earlier versions stored whole rows including passwords in a JSON index
+    legacy_index_file = current_path / 'search_index.json'
+    if legacy_index_file.exists() and not dry_run:
+        legacy_index_file.unlink()
+    index = SearchIndex.load(index_file)
+    if index is None or index.fingerprint != storage.fingerprint():
+        logger.debug('Building search index for repo...')
+        if index is not None:
+            index.close()
+        index = SearchIndex.build(storage.read_all() if storage.exists() else [], storage.fingerprint(),
+                                  file_name=None if dry_run else index_file)
+    return index
+
+class RepoRegistry:
+    """
+    Caches all repos found in the base directory. The base directory is only
+    scanned again after its modification time has changed, e.g. because a repo
+    was created or removed, or after the cache was invalidated explicitly.
+    """
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self._mtime = None
+        self._repos = []
+        self._repo_set = frozenset()
+        # repos by the name of their parent, built when needed after every scan
+        self._children = None
+
+    def invalidate(self):
+        self._mtime = None
+
+    def repos(self):
+        try:
+            mtime = self.base_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return []
+        if mtime != self._mtime:
+            logger.debug('Scanning base directory for repos...')
+            self._repos = sorted(d for d in self.base_path.iterdir() if d.is_dir() and (d/REPO_TOKEN).exists())
+            self._repo_set = frozenset(self._repos)
+            self._children = None
+            self._mtime = mtime
+        return self._repos
+
+    def children(self, repo_path):
+        """Returns all repos based on the given repo."""
+        self.repos()
+        if self._children is None:
+            self._children = {}
+            for r in self._repos:
+                parent = read_repo_config(r)['repo'].get('parent')
+                if parent:
+                    self._children.setdefault(parent, []).append(r)
+        return self._children.get(Path(repo_path).name, [])
+
+    def names(self):
+        return [r.name for r in self.repos()]
+
+    def __contains__(self, repo_path):
+        self.repos()
+        return repo_path in self._repo_set
+
+repo_registry = RepoRegistry(BASE_PATH)
 
 def list_all_repos():
-    return [d for d in BASE_PATH.iterdir() if d.is_dir() and (d/REPO_TOKEN).exists()]
+    return repo_registry.repos()
 
 def add_new_teacher(new_teacher):
-    with teacher_list() as l:
-        l.append(new_teacher)
+    storage = repo_storage()
+    names = AccountNameIndex(storage.read_all() if storage.exists() else [])
+    names.assign(new_teacher)
+    print_name_collisions(names.collisions)
+    if dry_run:
+        print('Testmodus: Lehrer {} wird nicht gespeichert.'.format(new_teacher))
+        return
+    with RepoLock(current_path):
+        materialize_children(current_path)
+        with search_index_updates(storage) as changes:
+            storage.add(new_teacher)
+            changes[str(new_teacher.guid)] = new_teacher
+
+def print_name_collisions(collisions):
+    if not collisions:
+        return
+    print('{} Namenskonflikte aufgelöst:'.format(len(collisions)))
+    for c in collisions:
+        print('   {}: {} {} -> {}'.format(c.teacher, c.field, c.original, c.assigned))
 
 def import_repo_into_repo(import_repo, destination_repo):
     """
-    Reads a given import file in CSV format and copies it into a given directory.
+    Bases a repo on another repo. Teachers list and blacklist are not copied,
+    the destination repo only references the imported repo as its parent and
+    stores its own changes as overlay. The command 'flatten' copies all data.
     """
     # TODO: Check whether to delete users from teachers list if they are marked as deleted.
-    destination_file = BASE_PATH / destination_repo / TEACHER_LIST_FILENAME
-    source_file = BASE_PATH / import_repo / TEACHER_LIST_FILENAME
-    if destination_file.exists():
+    import_path = BASE_PATH / import_repo
+    destination_path = BASE_PATH / destination_repo
+    if repo_storage(destination_path).exists():
         print('Fehler: Liste existiert bereits in angegebenen Repo.')
         return
-    if not source_file.exists():
+    if not repo_storage(import_path).exists():
         print('Fehler: Keine Liste in angegebenen Repo.')
         return
-    # copy teachers list to new repo
-    l = read_teacher_list(source_file)
-    for t in l:
-        # reset added flag because we are in new repo now
-        if t.added:
-            t.added = False
-    write_teacher_list(l, destination_file)
-    # copy blacklist to new repo
-    destination_file = BASE_PATH / destination_repo / BLACKLIST_FILENAME
-    source_file = BASE_PATH / import_repo / BLACKLIST_FILENAME
+    if destination_path == import_path or destination_path in repo_ancestors(import_path):
+        print('Fehler: Repo kann nicht auf sich selbst basieren.')
+        return
+    with RepoLock(destination_path):
+        materialize_children(destination_path)
+        config = read_repo_config(destination_path)
+        config['repo']['parent'] = import_path.name
+        write_repo_config(destination_path, config)
+
+@contextmanager
+def blacklist():
+    """Yields the blacklist of the current repo and writes all new entries at the end."""
+    b = repo_blacklist()
     try:
-        shutil.copy(source_file, destination_file)
-    except FileNotFoundError as e:
-        logger.debug('No blacklist file was found: {}'.format(e))
+        yield b
+    finally:
+        if dry_run:
+            b.discard()
+        else:
+            b.flush()
 
-def add_teacher_to_blacklist(t):
-    with open(current_path / BLACKLIST_FILENAME, 'a+', encoding='utf-8') as f:
-        f.write('{}\n'.format(t.guid))
+def add_teacher_to_blacklist(t, b):
+    """Adds a teacher to the blacklist yielded by blacklist()."""
+    if not b.changed:
+        # repos based on this one must not inherit the new entries, but
+        # checking them is only necessary before the first new entry
+        materialize_children(current_path)
+    b.add(t.guid)
 
-def is_teacher_in_blacklist(t):
-    try:
-        with open(current_path / BLACKLIST_FILENAME, 'r', encoding='utf-8') as f:
-            return t.guid in f.read().split()
-    except FileNotFoundError as e:
-        logger.debug('No blacklist file was found: {}'.format(e))
-        return False
+def is_teacher_in_blacklist(t, b):
+    return t.guid in b
+
+
+class UpdatePolicy:
+    """
+    Decisions for all questions of the update command, so that updates can run
+    without user interaction. Teachers found in an export that are neither in
+    the repo nor in the blacklist are accepted, blacklisted or skipped as given
+    for their GUID or otherwise as given by the parameter unknown.
+    """
+    DECISIONS = ('accept', 'blacklist', 'skip')
+
+    def __init__(self, unknown='skip', delete=True, accept=(), blacklist=()):
+        if unknown not in self.DECISIONS:
+            raise ValueError('Unknown decision for new teachers: {}'.format(unknown))
+        self.unknown = unknown
+        self.delete = delete
+        self.accept = {str(g).lower() for g in accept}
+        self.blacklist = {str(g).lower() for g in blacklist}
+
+    @classmethod
+    def from_file(cls, file_name):
+        """
+        Reads a policy from a JSON file, e.g.:
+        {"unknown": "skip", "delete": true, "accept": ["<guid>"], "blacklist": ["<guid>"]}
+        """
+        with open(file_name, 'r', encoding='utf-8') as f:
+            return cls(**json.load(f))
+
+    def decide(self, teacher):
+        guid = str(teacher.guid).lower()
+        if guid in self.accept:
+            return 'accept'
+        if guid in self.blacklist:
+            return 'blacklist'
+        return self.unknown
+
+def ask_for_unknown_teacher(t):
+    print('Neuer Lehrer in Importdatei gefunden: {}'.format(t))
+    should_import = prompt('Soll der Lehrer in das Repo aufgenommen werden? [y/N] ')
+    if should_import.lower() == 'y':
+        return 'accept'
+    should_blacklist = prompt('Soll der Lehrer in die Blacklist aufgenommen werden? [y/N] ')
+    if should_blacklist.lower() == 'y':
+        return 'blacklist'
+    return 'skip'
 
 ################################  Handler #####################################
 
@@ -134,6 +438,9 @@ def create_repo(args):
     if current_repo:
         print('Fehler: Bitte verlassen sie zuerst das aktuelle Repo.')
         return
+    if dry_run:
+        print('Fehler: Im Testmodus können keine Repos angelegt werden.')
+        return
     default_new_repo_name = datetime.today().strftime('%Y-%m-%d')
     new_repo_name = args[0] if args else default_new_repo_name
     # check whether dir exists
@@ -145,12 +452,13 @@ def create_repo(args):
     new_repo_path.mkdir()
     t = new_repo_path / REPO_TOKEN
     t.touch()
+    repo_registry.invalidate()
     open_repo([new_repo_name])
     # check whether to import user from different repo into new repo
     if len(args) == 3 and args[1] == 'from':
         import_file = args[2]
-        if not Path(import_file).exists():
-            print('Fehler: Angegebene Importdatei wurde nicht gefunden.')
+        if not BASE_PATH / import_file in repo_registry:
+            print('Fehler: Angegebenes Repo wurde nicht gefunden.')
             return
         import_repo_into_repo(import_file, current_path)
 
@@ -163,28 +471,73 @@ def open_repo(args):
         print('Fehler: Kein Name für das zu öffnende Repo angegeben.')
         return
     repo_name = args[0]
-    if not BASE_PATH / repo_name in list_all_repos():
+    if not BASE_PATH / repo_name in repo_registry:
         print('Fehler: Verzeichnis ist kein gültiges BBST-Repo.')
         return
     current_path = BASE_PATH / repo_name
     current_repo = repo_name
+    # generate new passwords with the length configured for this repo
+    password_pool.policy = PasswordPolicy(length=read_repo_config(current_path)['repo'].getint('password_length'))
 
 def close_repo():
     global current_path, current_repo
     current_path = BASE_PATH
     current_repo = ''
 
+def echo_table(rows, headers, row_count):
+    """
+    Prints a table line by line. Tables not fitting on the screen are shown
+    through a pager, which displays the first page before all lines are built.
+    """
+    lines = (line + '\n' for line in iter_grid_table(rows, headers))
+    if 2 * row_count + 3 <= shutil.get_terminal_size().lines:
+        for line in lines:
+            sys.stdout.write(line)
+    else:
+        click.echo_via_pager(lines)
+
+def parse_list_options(args):
+    """
+    Parses the parameters of the list command, e.g. 'all columns=guid,last_name sort=-last_name'.
+
+    :return: tuple of flag for all teachers, selected columns and sort key or None if invalid
+    """
+    show_all, columns, sort_key = False, TEACHER_FIELDS, None
+    for arg in args:
+        option, _, value = arg.partition('=')
+        if arg == 'all':
+            show_all = True
+        elif option == 'columns' and value:
+            columns = tuple(value.split(','))
+            if not set(columns) <= set(TEACHER_FIELDS):
+                print('Fehler: Unbekannte Spalte. Mögliche Spalten: {}'.format(', '.join(TEACHER_FIELDS)))
+                return None
+        elif option == 'sort' and value.lstrip('-') in TEACHER_FIELDS:
+            sort_key = value
+        else:
+            print('Fehler: Befehl <list> hat falschen Parameter.')
+            return None
+    return show_all, columns, sort_key
+
 def on_list(args):
     if current_repo:
-        if args and args[0] != 'all':
-            print('Fehler: Befehl <list> hat falschen Parameter.')
+        options = parse_list_options(args)
+        if options is None:
             return
-        with teacher_list() as l:
-            if not args:
+        show_all, columns, sort_key = options
+        with teacher_list(readonly=True) as l:
+            resolver = l.guid_resolver
+            if not show_all:
                 l = [t for t in l if t.added or t.deleted]
-            table = [astuple(x) for x in l]
-            headers = list(asdict(Teacher()).keys())
-            print(tabulate(table, headers, tablefmt="grid"))
+            if sort_key:
+                l = sorted(l, key=attrgetter(sort_key.lstrip('-')), reverse=sort_key.startswith('-'))
+            # show abbreviated GUIDs that can be used with print, amend and delete
+            values = attrgetter(*columns)
+            rows = ((values(x),) if len(columns) == 1 else values(x) for x in l)
+            if 'guid' in columns:
+                guid_column = columns.index('guid')
+                rows = (r[:guid_column] + (resolver.abbreviate(r[guid_column]),) + r[guid_column+1:] for r in rows)
+            echo_table(rows, columns, len(l))
     else:
         print('Verfügbare Repos im Basisverzeichnis:')
         repo_list = list_all_repos()
@@ -195,18 +548,23 @@ def on_list(args):
             print('Keine Repos gefunden!')
 
 def on_search(args):
+    from tabulate import tabulate
     if not current_repo:
         print('Fehler: Suchen nur in Repo möglich.')
         return
     if not args:
         print('Fehler: Keine Suchbegriff angegeben.')
         return
-    with teacher_list() as l:
-        query = args[0]
-        l = [t for t in l if t.first_name.find(query) != -1 or t.last_name.find(query) != -1 or t.email.find(query) != -1]
-        table = [astuple(x) for x in l]
-        headers = list(asdict(Teacher()).keys())
-        print(tabulate(table, headers, tablefmt="grid"))
+    storage = repo_storage()
+    index = search_index(storage)
+    try:
+        guids = index.search(' '.join(args))
+    finally:
+        index.close()
+    l = storage.get_many(guids) if guids else []
+    table = [teacher_row(x) for x in l]
+    headers = TEACHER_FIELDS
+    print(tabulate(table, headers, tablefmt="grid"))
 
 def on_add():
     if not current_repo:
@@ -223,7 +581,15 @@ def on_add():
                           username=generate_username(first_name, last_name))
     add_new_teacher(new_teacher)
 
-def on_update(args):
+def on_update(args, policy=None):
+    """
+    Updates the current repo with a teachers list exported by BBS Verwaltung.
+    Without a policy the user is asked how to handle unknown teachers and
+    whether to delete teachers.
+
+    :param policy: UpdatePolicy with decisions for all questions
+    :return: dictionary summarizing the update
+    """
     if not current_repo:
         print('Fehler: Aktualisierung ist nur in Repo möglich.')
         return
@@ -234,38 +600,56 @@ def on_update(args):
     if not update_file.exists():
         print('Fehler: Zu übernehmende Datendatei existiert nicht.')
         return
-    new_teachers, deleted_teachers, all_teachers = read_bbsv_file(update_file)
-    #
+    storage = repo_storage()
+    if not storage.exists() and not dry_run:
+        # a new repo has no list yet, create it so that the update can be saved
+        with RepoLock(current_path):
+            if not storage.exists():
+                storage.write_all([])
     number_of_added_teachers = 0
-    with teacher_list() as l:
-        for t in all_teachers:
-            # add marked teacher if not already in list
-            if t.added:
-                if not t in l:
-                    l.append(t)
-                    number_of_added_teachers += 1
-                continue
-            # check if the guid is already in teachers list
-            found = None
-            for tl in l:
-                if tl.guid == t.guid:
-                    found = t
-                    break
-            if not found and not is_teacher_in_blacklist(t):
-                print('Neuer Lehrer in Importdatei gefunden: {}'.format(t))
-                should_import = prompt('Soll der Lehrer in das Repo aufgenommen werden? [y/N] ')
-                if should_import.lower() == 'y':
-                    t.added = True
-                    l.append(t)
-                    number_of_added_teachers += 1
-                else:
-                    should_blacklist = prompt('Soll der Lehrer in die Blacklist aufgenommen werden? [y/N] ')
-                    if should_blacklist.lower() == 'y':
-                        add_teacher_to_blacklist(t)
+    number_of_blacklisted_teachers = 0
+    number_of_skipped_teachers = 0
+    with teacher_list() as l, blacklist() as b:
+        with phase('update.reconcile') as record:
+            diff = TeacherIndex(l).reconcile(iter_bbsv_file(update_file), blacklist=b)
+            record['rows'] = diff.total
+        print('{} Lehrer aus Datei eingelesen.'.format(diff.total))
+        names = AccountNameIndex(l)
+        # add all teachers marked as new
+        for t in diff.new:
+            names.assign(t)
+            l.append(t)
+            number_of_added_teachers += 1
+        # decide for all teachers neither in the repo nor in the blacklist
+        for t in diff.unknown:
+            decision = ask_for_unknown_teacher(t) if policy is None else policy.decide(t)
+            if decision == 'accept':
+                t.added = True
+                names.assign(t)
+                l.append(t)
+                number_of_added_teachers += 1
+            elif decision == 'blacklist':
+                add_teacher_to_blacklist(t, b)
+                number_of_blacklisted_teachers += 1
+            else:
+                number_of_skipped_teachers += 1
+        for guid, changes in diff.changed.items():
+            changed_fields = ', '.join('{}: {} -> {}'.format(f, old, new) for f, (old, new) in changes.items())
+            print('Geänderte Daten für Lehrer {} in Importdatei: {}'.format(guid, changed_fields))
+        # mark all deleted teachers at once before the list is written
+        if policy is None:
+            deleted_teachers = delete_teachers(l, diff.deleted)
+        else:
+            deleted_teachers = delete_teachers(l, diff.deleted, confirm=False) if policy.delete else []
+        for t in deleted_teachers:
+            print('Lehrer {} wurde als gelöscht markiert.'.format(t))
     print('{} neue Lehrer hinzugefügt.'.format(number_of_added_teachers))
-    for t in deleted_teachers:
-        on_delete([t.guid])
-        print('Lehrer {} wurde als gelöscht markiert.'.format(t))
+    print_name_collisions(names.collisions)
+    return {'repo': current_repo, 'file': str(update_file), 'read': diff.total,
+            'added': number_of_added_teachers, 'blacklisted': number_of_blacklisted_teachers,
+            'skipped': number_of_skipped_teachers,
+            'deleted': len(deleted_teachers), 'changed': len(diff.changed),
+            'name_collisions': len(names.collisions), 'dry_run': dry_run}
 
 def on_import(args):
     if not current_repo:
@@ -276,42 +660,81 @@ def on_import(args):
         return
     import_repo_name = args[0]
     import_repo = BASE_PATH / import_repo_name
-    if not import_repo in list_all_repos():
+    if not import_repo in repo_registry:
         print('Fehler: Kein gültiges zu importierendes Repo angegeben.')
         return
+    if dry_run:
+        print('Fehler: Im Testmodus kann keine Liste importiert werden.')
+        return
     print(f'Importiere Liste aus Repo {import_repo_name}...')
     import_repo_into_repo(import_repo, current_repo)
 
-def on_export():
+def on_export(args):
+    """
+    Exports all teachers changed since the last export into all formats.
+    Formats marked as full roster always contain all teachers. Output files
+    whose content would not change are not written again and nothing is
+    written at all if no teacher was changed. With the parameter 'full' all
+    teachers are exported.
+    """
+    from bbst.pdf import UserInfoSink
     if not current_repo:
         print('Fehler: Export ist nur in Repo möglich.')
         return
+    if not set(args) <= {'split', 'full'}:
+        print('Fehler: Befehl <export> hat falschen Parameter.')
+        return
+    full = 'full' in args
     print('Exportieren aktuelles Repo in alle Exportformate...')
-    
-    with teacher_list() as l:
-        output_file = current_path / MOODLE_FILENAME
-        write_moodle_file(l, output_file=output_file)
-        #
-        output_file = current_path / LOGODIDACT_FILENAME
-        write_logodidact_file(l, output_file=output_file)
-        #
-        output_file = current_path / NBC_FILENAME
-        write_nbc_file(l, output_file=output_file)
-        #
-        output_file = current_path / RADIUS_FILENAME
-        write_radius_file(l, output_file=output_file)
-        #
-        output_file = current_path / WEBUNTIS_FILENAME
-        write_webuntis_file(l, output_file=output_file)
-        #
-        output_file = current_path / USER_INFO_FILENAME
-        only_new_teachers = [t for t in l if t.added]
-        if only_new_teachers:
-            create_user_info_document(str(output_file), only_new_teachers)
+    manifest = ExportManifest(current_path / EXPORT_MANIFEST_FILENAME)
+    if manifest.watermark and not full:
+        print('Exportiere nur seit dem letzten Export ({}) geänderte Lehrer.'.format(manifest.watermark))
+    sinks = [MoodleSink(current_path / MOODLE_FILENAME),
+             LogodidactSink(current_path / LOGODIDACT_FILENAME),
+             NbcSink(current_path / NBC_FILENAME),
+             RadiusSink(current_path / RADIUS_FILENAME),
+             WebuntisSink(current_path / WEBUNTIS_FILENAME),
+             UserInfoSink(current_path / USER_INFO_FILENAME)]
+    if 'split' in args:
+        # write a separate user info document for each teacher
+        sinks[-1] = UserInfoSink(current_path / USER_INFO_DIRNAME, per_teacher=True)
+    format_names = [s.name for s in sinks]
+    with teacher_list(readonly=True) as l:
+        exported_teachers = l if full else manifest.changed_teachers(l)
+        if not exported_teachers:
+            print('Keine Änderungen seit dem letzten Export.')
+        teachers = {s.name: l if s.full_roster else exported_teachers for s in sinks}
+        format_hashes = {s.name: manifest.format_hash(s, teachers[s.name]) for s in sinks}
+        # skip formats with unchanged content, other formats without changed teachers
+        # are written empty, so that the teachers of the last export are not imported
+        # again, but user info documents are never replaced by an empty document
+        skipped_sinks = [s for s in sinks if not exported_teachers or manifest.is_unchanged(s, format_hashes[s.name])]
+        empty_sinks = [s for s in sinks if s not in skipped_sinks and s.collect
+                       and not any(s.accepts(t) for t in teachers[s.name])]
+        written_sinks = [s for s in sinks if s not in skipped_sinks and s not in empty_sinks]
+        results = []
+        for roster in (False, True):
+            pipeline = ExportPipeline([s for s in written_sinks if s.full_roster == roster])
+            if pipeline.sinks:
+                results += pipeline.run(l if roster else exported_teachers, dry_run=dry_run)
+        if not dry_run and exported_teachers:
+            with RepoLock(current_path):
+                manifest.record(l, {s.name: format_hashes[s.name] for s in written_sinks})
+                manifest.save()
+    results += [ExportResult(s.name, s.output_file, 0, 0.0, skipped=True) for s in skipped_sinks]
+    results += [ExportResult(s.name, s.output_file, 0, 0.0) for s in empty_sinks]
+    results.sort(key=lambda r: format_names.index(r.name))
+    for r in results:
+        if r.skipped:
+            print('   {:<12} unverändert, Datei wird nicht neu geschrieben'.format(r.name))
         else:
-            print('Fehler: Keine neuen Lehrer in Repo.')
+            print('   {:<12} {:>6} Lehrer  {:>8.2f}s'.format(r.name, r.count, r.seconds))
+    if any(not (r.count or r.skipped) for r in results if r.name == UserInfoSink.name):
+        print('Fehler: Keine neuen Lehrer in Repo.')
+    return results
 
 def on_print(args):
+    from bbst.pdf import create_user_info_document
     if not current_repo:
         print('Fehler: Export ist nur in Repo möglich.')
         return
@@ -319,9 +742,9 @@ def on_print(args):
         print('Fehler: Keine GUID angegeben.')
         return
     print('Exportieren Anschreiben für ausgewählten Lehrer...')
-    with teacher_list() as l:
+    with teacher_list(readonly=True) as l:
         # find teacher whose GUID starts with given argument
-        chosen_teacher = [t for t in l if t.guid.startswith(args[0])]
+        chosen_teacher = l.find(args[0])
         if len(chosen_teacher) != 1:
             print('Fehler: Kein oder zu viele Übereinstimmungen gefunden.')
             return
@@ -335,24 +758,53 @@ def on_amend(args):
     if not args:
         print('Fehler: Keine GUID angegeben.')
         return
-    current_repo_list = current_path / TEACHER_LIST_FILENAME
-    l = read_teacher_list(current_repo_list)
+    storage = repo_storage()
+    l = TeacherList(storage.read_all())
     # find teacher whose GUID starts with given argument
-    chosen_teacher = [t for t in l if t.guid.startswith(args[0])]
+    chosen_teacher = l.find(args[0])
     if len(chosen_teacher) != 1:
         print('Fehler: Kein oder zu viele Übereinstimmungen gefunden.')
         return
+    # remember the teacher as read to detect changes by other sessions while asking
+    original_row = teacher_row(chosen_teacher[0])
     # ask for changed information
     first_name = prompt('Geben Sie den neuen Vornamen ein: ', default=chosen_teacher[0].first_name)
     last_name = prompt('Geben Sie den neuen Nachnamen ein: ', default=chosen_teacher[0].last_name)
     email = prompt('Geben Sie die neue Email-Adresse ein: ', default=chosen_teacher[0].email)
     username = prompt('Geben Sie den neuen Benutzernamen ein: ', default=chosen_teacher[0].username)
-    # remove old teacher and add amended teacher
-    l.remove(chosen_teacher[0])
-    l.append(Teacher(last_name=last_name, first_name=first_name, email=email, username=username,
-                     guid=chosen_teacher[0].guid, password=chosen_teacher[0].password,
-                     added=chosen_teacher[0].added, deleted=chosen_teacher[0].deleted))
-    write_teacher_list(l, current_repo_list)
+    # replace old teacher with amended teacher
+    amended_teacher = replace(chosen_teacher[0], last_name=last_name, first_name=first_name,
+                              email=email, username=username)
+    if dry_run:
+        print('Testmodus: Änderungen werden nicht gespeichert.')
+        return
+    with RepoLock(current_path):
+        stored_teacher = storage.get(amended_teacher.guid)
+        if stored_teacher is None or teacher_row(stored_teacher) != original_row:
+            raise ConflictError([str(amended_teacher.guid)])
+        materialize_children(current_path)
+        with search_index_updates(storage) as changes:
+            storage.update(amended_teacher)
+            changes[amended_teacher.guid] = amended_teacher
+
+def delete_teachers(l, teachers, purge=False, confirm=True):
+    """
+    Marks the given teachers in a teachers list as deleted or removes them
+    completely after asking once for confirmation.
+
+    :return: list of deleted teachers
+    """
+    if not teachers:
+        return []
+    if confirm:
+        print('Folgende Lehrer werden {}:'.format('endgültig entfernt' if purge else 'als gelöscht markiert'))
+        for t in teachers:
+            print('   {} {}'.format(l.guid_resolver.abbreviate(t.guid), t))
+        really = prompt('Sollen diese {} Lehrer wirklich gelöscht werden? [y/N] '.format(len(teachers)))
+        if really.lower() != 'y':
+            return []
+    guids = [t.guid for t in teachers]
+    return l.purge(guids) if purge else l.mark_deleted(guids)
 
 def on_delete(args, purge=False):
     if not current_repo:
@@ -362,26 +814,81 @@ def on_delete(args, purge=False):
     if not args:
         print('Fehler: Keine GUID angegeben.')
         return
-    current_repo_list = current_path / TEACHER_LIST_FILENAME
-    l = read_teacher_list(current_repo_list)
-    # find teacher whose GUID starts with given argument
-    chosen_teacher = [t for t in l if t.guid.startswith(args[0])]
-    if len(chosen_teacher) != 1:
-        print('Fehler: Kein oder zu viele Übereinstimmungen gefunden.')
+    with teacher_list() as l:
+        chosen_teachers = []
+        for guid_prefix in args:
+            # find teacher whose GUID starts with given argument
+            chosen_teacher = l.find(guid_prefix)
+            if len(chosen_teacher) != 1:
+                print('Fehler: Kein oder zu viele Übereinstimmungen für {} gefunden.'.format(guid_prefix))
+                return
+            chosen_teachers.append(chosen_teacher[0])
+        delete_teachers(l, chosen_teachers, purge)
+
+DIFF_COLUMNS = ('status', 'guid', 'last_name', 'first_name', 'field', 'old', 'new')
+
+def diff_rows(changes):
+    """Yields a row for every changed field and for every added or removed teacher."""
+    for c in changes:
+        if not c.changes:
+            yield (c.status, c.guid, c.last_name, c.first_name, '', '', '')
+        for field_name, (old, new) in c.changes.items():
+            yield (c.status, c.guid, c.last_name, c.first_name, field_name, old, new)
+
+def read_other_teachers(other):
+    """
+    Returns the teachers of a repo or the rows of a file exported by BBS
+    Verwaltung to be compared with the current repo and the fields to compare,
+    or None if neither exists. Mail addresses and user names of exported rows
+    are derived from the names without resolving collisions like an update, so
+    only the names are compared for exports.
+    """
+    if BASE_PATH / other in repo_registry:
+        storage = repo_storage(other)
+        return (storage.read_all() if storage.exists() else []), TeacherIndex.DIFF_FIELDS
+    export_file = (current_path / other).resolve()
+    if export_file.is_file():
+        return iter_bbsv_file(export_file), TeacherIndex.COMPARED_FIELDS
+    return None
+
+def on_diff(args):
+    """
+    Compares the current repo with another repo or an export of BBS
+    Verwaltung without changing anything. With the parameter 'csv' the
+    differences are written as CSV instead of a table.
+    """
+    if not current_repo:
+        print('Fehler: Vergleich ist nur in Repo möglich.')
+        return
+    if not args:
+        print('Fehler: Kein Repo und keine Datei zum Vergleich angegeben.')
         return
-    really = prompt('Soll der Lehrer "{}" wirklich gelöscht werden? [y/N] '.format(chosen_teacher[0]))
-    if really.lower() == 'y':
-        l.remove(chosen_teacher[0])
-        if not purge:
-            l.append(replace(chosen_teacher[0], deleted=True))
-        write_teacher_list(l, current_repo_list)
+    if len(args) > 2 or args[1:] not in ([], ['csv']):
+        print('Fehler: Befehl <diff> hat falschen Parameter.')
+        return
+    other = read_other_teachers(args[0])
+    if other is None:
+        print('Fehler: Angegebenes Repo bzw. angegebene Datei wurde nicht gefunden.')
+        return
+    other_teachers, fields = other
+    with teacher_list(readonly=True) as l, phase('diff') as record:
+        changes = TeacherIndex(l).diff(other_teachers, fields=fields)
+        record['rows'] = len(changes)
+    if 'csv' in args[1:]:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(DIFF_COLUMNS)
+        writer.writerows(diff_rows(changes))
+        return changes
+    echo_table(diff_rows(changes), DIFF_COLUMNS, sum(max(1, len(c.changes)) for c in changes))
+    counts = Counter(c.status for c in changes)
+    print('{} neue, {} entfernte und {} geänderte Lehrer.'.format(counts['added'], counts['removed'], counts['changed']))
+    return changes
 
 def on_stats():
     if not current_repo:
         print('Fehler: Statistik ist nur in Repo möglich.')
         return
-    current_repo_list = current_path / TEACHER_LIST_FILENAME
-    teachers = read_teacher_list(current_repo_list)
+    teachers = repo_storage().read_all()
     names = [t.first_name.strip() for t in teachers]
     occurrences = {k: v for k, v in Counter(names).items() if v > 1}
     occurrences = sorted(occurrences.items(), key=lambda kv: kv[1], reverse=True)
@@ -389,17 +896,74 @@ def on_stats():
     for o in occurrences:
         print(' [{0: >15}] {1} ({2})'.format(o[0], '#' * int(60 / maximum * int(o[1])), o[1]))
 
+def on_storage(args):
+    if not current_repo:
+        print('Fehler: Speicherformat kann nur in Repo geändert werden.')
+        return
+    config = read_repo_config(current_path)
+    current_backend = config['repo']['storage']
+    if not args:
+        print('Aktuelles Speicherformat: {}'.format(current_backend))
+        return
+    new_backend = args[0]
+    if new_backend not in STORAGE_BACKENDS:
+        print('Fehler: Unbekanntes Speicherformat. Mögliche Formate: {}'.format(', '.join(STORAGE_BACKENDS)))
+        return
+    if new_backend == current_backend:
+        return
+    if config['repo'].get('parent'):
+        print('Fehler: Repo basiert auf Repo {}, bitte zuerst mit <flatten> alle Daten übernehmen.'.format(config['repo']['parent']))
+        return
+    if dry_run:
+        print('Fehler: Im Testmodus kann das Speicherformat nicht geändert werden.')
+        return
+    # copy all teachers into the new storage backend
+    with RepoLock(current_path):
+        old_storage = repo_storage()
+        if old_storage.exists():
+            open_storage(current_path, new_backend).write_all(old_storage.read_all())
+        config['repo']['storage'] = new_backend
+        write_repo_config(current_path, config)
+    print('Speicherformat von {} zu {} geändert.'.format(current_backend, new_backend))
+
+def on_flatten():
+    if not current_repo:
+        print('Fehler: Übernehmen der Daten ist nur in Repo möglich.')
+        return
+    parent = parent_repo(current_path, allow_missing=True)
+    if not parent:
+        print('Fehler: Repo basiert auf keinem anderen Repo.')
+        return
+    if dry_run:
+        print('Fehler: Im Testmodus können keine Daten übernommen werden.')
+        return
+    parent_missing = BASE_PATH / parent not in repo_registry
+    if parent_missing:
+        print('Repo {} existiert nicht mehr, es werden nur die Änderungen aus diesem Repo übernommen.'.format(parent))
+        if prompt('Soll das Repo trotzdem vom Repo {} gelöst werden? [y/N] '.format(parent)).lower() != 'y':
+            return
+    materialize_repo(current_path, allow_missing_parent=parent_missing)
+    if parent_missing:
+        print('Repo vom Repo {} gelöst.'.format(parent))
+    else:
+        print('Alle Daten aus Repo {} übernommen.'.format(parent))
+
 ##################################  CLI  ######################################
 
 def prepare_completers(commands):
+    """
+    Builds all completers once. The repo names are fetched from the registry
+    whenever completions are needed, so that new repos are completed, too.
+    """
+    from prompt_toolkit.completion import WordCompleter, PathCompleter, merge_completers
     completer_commands = WordCompleter(commands)
-    repos = [str(r.parts[-1:][0]) for r in list_all_repos()]
-    completer_repos = WordCompleter(repos)
+    completer_repos = WordCompleter(repo_registry.names)
     completer_files = PathCompleter(file_filter=lambda filename: str(filename).endswith('.csv'),
                                     min_input_len=0, get_paths=lambda : [current_path])
     return merge_completers([completer_commands, completer_repos, completer_files])
 
 def prepare_key_bindings():
+    from prompt_toolkit.key_binding import KeyBindings
     bindings = KeyBindings()
     @bindings.add('c-x')
     def _(event):
@@ -408,6 +972,10 @@ def prepare_key_bindings():
     return bindings
 
 def prepare_cli_interface(commands):
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.styles import Style
+    from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
+    from prompt_toolkit.history import FileHistory
     style = Style.from_dict({
         # user input (default text)
         '':       '#00ff00',
@@ -424,17 +992,25 @@ def prepare_cli_interface(commands):
                             bottom_toolbar=toolbar_text, complete_while_typing=True)
     return session
 
-@click.command()
+@click.group(invoke_without_command=True)
 @click.option('--verbose', '-v', is_flag=True, help='Enables verbose mode.', default=False)
 @click.option('--test', is_flag=True, help='No changes are written to disk.', default=False)
+@click.option('--profile', is_flag=True, help='Writes a cProfile report for every command.', default=False)
 @click.version_option('0.1')
-def main_loop(test, verbose):
+@click.pass_context
+def main_loop(ctx, test, verbose, profile):
     "Simple tool for managing user accounts for teachers at a vocational school."
+    global dry_run, profile_commands
+    dry_run = test
+    profile_commands = profile
+    if ctx.invoked_subcommand:
+        return
 
     # TODO: Add command 'amend' to change and 'delete' to remove entry.
     commands = ['new', 'import', 'export', 'open', 'close', 'list', 'add',
                 'update', 'help', 'exit', 'quit', 'amend', 'delete', 'print',
-                'stats', 'search']
+                'stats', 'search', 'storage', 'flatten', 'diff']
+    install_event_loop()
     session = prepare_cli_interface(commands)
 
     while True:
@@ -444,7 +1020,7 @@ def main_loop(test, verbose):
                                ('class:pound', ' ➭ ') ]
         else:
             prompt_message = [ ('class:pound', ' ➭ ') ]
-        user_input = session.prompt(prompt_message, completer=prepare_completers(commands))
+        user_input = session.prompt(prompt_message)
         if not user_input:
             continue
         else:
@@ -452,39 +1028,157 @@ def main_loop(test, verbose):
         command, args = user_input[0], user_input[1:]
         if command == 'exit' or command == 'quit':
             return
-        elif command == 'help':
-            # TODO: Add more information on available commands.
-            print('Mögliche Befehle: ', ', '.join(commands))
-        elif command == 'new':
-            create_repo(args)
-        elif command == 'open' or command == 'cd':
-            open_repo(args)
-        elif command == 'close':
-            close_repo()
-        elif command == 'list' or command == 'ls':
-            on_list(args)
-        elif command == 'search':
-            on_search(args)
-        elif command == 'import':
-            on_import(args)
-        elif command == 'export':
-            on_export()
-        elif command == 'amend':
-            on_amend(args)
-        elif command == 'delete':
-            on_delete(args)
-        elif command == 'purge':
-            on_delete(args, True)
-        elif command == 'add':
-            on_add()
-        elif command == 'update':
-            on_update(args)
-        elif command == 'stats':
-            on_stats()
-        elif command == 'print':
-            on_print(args)
-        else:
-            print('Fehler: Befehl ungültig. Verwenden Sie den Befehl "help" für weitere Informationen.')
+        with command_scope(command):
+            if command == 'help':
+                # TODO: Add more information on available commands.
+                print('Mögliche Befehle: ', ', '.join(commands))
+            elif command == 'new':
+                create_repo(args)
+            elif command == 'open' or command == 'cd':
+                open_repo(args)
+            elif command == 'close':
+                close_repo()
+            elif command == 'list' or command == 'ls':
+                on_list(args)
+            elif command == 'search':
+                on_search(args)
+            elif command == 'import':
+                on_import(args)
+            elif command == 'export':
+                on_export(args)
+            elif command == 'amend':
+                on_amend(args)
+            elif command == 'delete':
+                on_delete(args)
+            elif command == 'purge':
+                on_delete(args, True)
+            elif command == 'add':
+                on_add()
+            elif command == 'update':
+                on_update(args)
+            elif command == 'stats':
+                on_stats()
+            elif command == 'print':
+                on_print(args)
+            elif command == 'storage':
+                on_storage(args)
+            elif command == 'flatten':
+                on_flatten()
+            elif command == 'diff':
+                on_diff(args)
+            else:
+                print('Fehler: Befehl ungültig. Verwenden Sie den Befehl "help" für weitere Informationen.')
+        # write all blacklist entries collected while executing the command
+        flush_blacklists(discard=dry_run)
+
+@contextmanager
+def command_scope(command):
+    """
+    Logs the runtime of a command and profiles it if requested. The profile
+    files are written into the base directory.
+    """
+    try:
+        with profiled(command, enabled=profile_commands, directory=str(BASE_PATH)), phase('command', command=command):
+            yield
+    except LockTimeout as e:
+        print('Fehler: Repo wird gerade von einem anderen Benutzer bearbeitet ({}), bitte später erneut versuchen.'.format(
+              e.owner.get('host', '?') if e.owner else '?'))
+    except ConflictError as e:
+        print('Fehler: {} Lehrer wurden zwischenzeitlich von einem anderen Benutzer geändert. '
+              'Änderungen wurden nicht gespeichert.'.format(len(e.guids)))
+    except MissingParentRepo as e:
+        print('Fehler: Repo {} basiert auf Repo {}, das nicht gefunden wurde. Bitte Repo {} wiederherstellen '
+              'oder Repo {} mit <flatten> davon lösen.'.format(e.repo, e.parent, e.parent, e.repo))
+
+@contextmanager
+def messages_to_stderr():
+    """
+    Writes all messages for users to stderr instead of stdout, so that the
+    output of a subcommand contains only its machine-readable summary.
+    """
+    handlers = [h for h in logger.handlers if isinstance(h, logging.StreamHandler) and h.stream is sys.stdout]
+    for h in handlers:
+        h.setStream(sys.stderr)
+    try:
+        with redirect_stdout(sys.stderr):
+            yield
+    finally:
+        for h in handlers:
+            h.setStream(sys.stdout)
+
+def open_repo_or_exit(repo):
+    open_repo([repo])
+    if not current_repo:
+        click.get_current_context().exit(1)
+
+@main_loop.command('update')
+@click.argument('repo')
+@click.argument('update_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--auto-accept', is_flag=True, help='Adds all unknown teachers to the repo.')
+@click.option('--auto-blacklist', is_flag=True, help='Adds all unknown teachers to the blacklist.')
+@click.option('--keep-deleted', is_flag=True, help='Does not mark teachers deleted in the export as deleted.')
+@click.option('--policy', 'policy_file', type=click.Path(exists=True, dir_okay=False),
+              help='JSON file with decisions for single teachers.')
+@click.option('--dry-run', 'no_changes', is_flag=True, help='No changes are written to disk.')
+def update_command(repo, update_file, auto_accept, auto_blacklist, keep_deleted, policy_file, no_changes):
+    "Updates a repo with a teachers list exported by BBS Verwaltung without asking."
+    global dry_run
+    dry_run = dry_run or no_changes
+    if auto_accept and auto_blacklist:
+        raise click.UsageError('Options --auto-accept and --auto-blacklist are mutually exclusive.')
+    try:
+        policy = UpdatePolicy.from_file(policy_file) if policy_file else UpdatePolicy()
+    except (ValueError, TypeError) as e:
+        raise click.BadParameter(str(e), param_hint='--policy')
+    if auto_accept:
+        policy.unknown = 'accept'
+    if auto_blacklist:
+        policy.unknown = 'blacklist'
+    if keep_deleted:
+        policy.delete = False
+    summary = None
+    with messages_to_stderr():
+        open_repo_or_exit(repo)
+        with command_scope('update'):
+            summary = on_update([str(Path(update_file).resolve())], policy=policy)
+    if summary is None:
+        click.get_current_context().exit(1)
+    click.echo(json.dumps(summary, ensure_ascii=False))
+
+@main_loop.command('export')
+@click.argument('repo')
+@click.option('--split', is_flag=True, help='Writes a separate user info document for each teacher.')
+@click.option('--full', is_flag=True, help='Exports all teachers instead of only the changed ones.')
+@click.option('--dry-run', 'no_changes', is_flag=True, help='Only counts the teachers to be exported.')
+def export_command(repo, split, full, no_changes):
+    "Exports a repo into all export formats."
+    global dry_run
+    dry_run = dry_run or no_changes
+    args = (['split'] if split else []) + (['full'] if full else [])
+    results = None
+    with messages_to_stderr():
+        open_repo_or_exit(repo)
+        with command_scope('export'):
+            results = on_export(args)
+    # the export was aborted, e.g. because the repo is locked by another user
+    if results is None:
+        click.get_current_context().exit(1)
+    summary = {'repo': current_repo, 'dry_run': dry_run, 'full': full,
+               'formats': [{'name': r.name, 'file': str(r.output_file), 'count': r.count,
+                            'seconds': round(r.seconds, 3), 'skipped': r.skipped} for r in results]}
+    click.echo(json.dumps(summary, ensure_ascii=False))
+
+@main_loop.command('diff')
+@click.argument('repo')
+@click.argument('other')
+@click.option('--csv', 'as_csv', is_flag=True, help='Writes the differences as CSV.')
+def diff_command(repo, other, as_csv):
+    "Compares a repo with another repo or a teachers list exported by BBS Verwaltung."
+    open_repo_or_exit(repo)
+    if Path(other).is_file():
+        other = str(Path(other).resolve())
+    with command_scope('diff'):
+        on_diff([other] + (['csv'] if as_csv else []))
 
 def create_logger():
     # create logger for this application
@@ -0,0 +1,93 @@
+#! /usr/bin/env python3
+
+"""
+Generates synthetic user lists in the format exported by BBS Verwaltung: 13
+columns separated by semicolons in a UTF-8 file with byte order mark.
+
+Usage: python benchmarks/generate_bbsv.py OUTPUT_FILE [--count N] [--new RATIO] [--deleted RATIO]
+"""
+
+import os
+import sys
+import uuid
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bbst.fileops import BBSV_FIELDNAMES
+
+
+PLAIN_LAST_NAMES = ['Schmidt', 'Schneider', 'Fischer', 'Meyer', 'Wagner', 'Becker', 'Hoffmann',
+                    'Koch', 'Richter', 'Klein', 'Wolf', 'Neumann', 'Schwarz', 'Zimmermann']
+UMLAUT_LAST_NAMES = ['Müller', 'Schäfer', 'Köhler', 'Jäger', 'Weiß', 'Groß', 'Möller', 'Bäcker',
+                     'Döring', 'Günther', 'Müßig', 'Krüger', 'Gärtner', 'Böhm', 'Strauß',
+                     'Kühn', 'Schröder', 'Öztürk', 'Łukasiewicz', 'Ørsted', 'Dvořák']
+PLAIN_FIRST_NAMES = ['Anna', 'Peter', 'Thomas', 'Julia', 'Michael', 'Sabine', 'Andreas',
+                     'Stefan', 'Claudia', 'Martin', 'Petra', 'Frank']
+UMLAUT_FIRST_NAMES = ['Jürgen', 'Jörg', 'Björn', 'Zoë', 'Renée', 'Sören', 'Ümit', 'Jörn',
+                      'Małgorzata', 'André', 'François', 'Özlem', 'Hans-Jürgen', 'Käthe']
+
+# flags as written by BBS Verwaltung
+TRUE, FALSE = '-1', '0'
+
+
+def generate_bbsv_rows(count, new_ratio=0.05, deleted_ratio=0.02, umlaut_ratio=0.5,
+                       student_ratio=0.0, seed=0):
+    """
+    Yields rows of a synthetic export with one value for every column in
+    BBSV_FIELDNAMES.
+
+    :param count: number of users
+    :param new_ratio: fraction of users marked as new
+    :param deleted_ratio: fraction of users marked as deleted
+    :param umlaut_ratio: fraction of names containing umlauts or other special characters
+    :param student_ratio: fraction of users that are students instead of teachers
+    :param seed: seed for the random generator, so that the same file is generated again
+    """
+    rng = random.Random(seed)
+    for _ in range(count):
+        umlauts = rng.random() < umlaut_ratio
+        last_name = rng.choice(UMLAUT_LAST_NAMES if umlauts else PLAIN_LAST_NAMES)
+        first_name = rng.choice(UMLAUT_FIRST_NAMES if umlauts else PLAIN_FIRST_NAMES)
+        if rng.random() < 0.1:
+            last_name = '{}-{}'.format(last_name, rng.choice(PLAIN_LAST_NAMES))
+        values = {
+            'guid': str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            'email': '',
+            'short_name': ''.join(rng.choice('ABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(3)),
+            'last_name': last_name,
+            'first_name': first_name,
+            'classes': '',
+            'courses': '',
+            'birthday': '{:02d}.{:02d}.{}'.format(rng.randint(1, 28), rng.randint(1, 12), rng.randint(1955, 1995)),
+            'initial_password': '',
+            'deleted': TRUE if rng.random() < deleted_ratio else FALSE,
+            'new': TRUE if rng.random() < new_ratio else FALSE,
+            'teacher': FALSE if rng.random() < student_ratio else TRUE,
+            'groups': '',
+        }
+        yield [values[f] for f in BBSV_FIELDNAMES]
+
+def write_bbsv_file(file_name, count, **kwds):
+    """Writes a synthetic export with the given number of users, see generate_bbsv_rows()."""
+    with open(file_name, 'w', encoding='utf-8-sig', newline='') as f:
+        for row in generate_bbsv_rows(count, **kwds):
+            f.write(';'.join(row))
+            f.write('\r\n')
+
+def main():
+    parser = argparse.ArgumentParser(description='Generates synthetic exports of BBS Verwaltung.')
+    parser.add_argument('output_file')
+    parser.add_argument('--count', type=int, default=1000, help='number of users')
+    parser.add_argument('--new', type=float, default=0.05, help='fraction of new users')
+    parser.add_argument('--deleted', type=float, default=0.02, help='fraction of deleted users')
+    parser.add_argument('--umlauts', type=float, default=0.5, help='fraction of names with umlauts')
+    parser.add_argument('--students', type=float, default=0.0, help='fraction of students')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the random generator')
+    args = parser.parse_args()
+    write_bbsv_file(args.output_file, args.count, new_ratio=args.new, deleted_ratio=args.deleted,
+                    umlaut_ratio=args.umlauts, student_ratio=args.students, seed=args.seed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#! /usr/bin/env python3
+
+"""
+Benchmark suite for reading exports of BBS Verwaltung, updating repos and
+writing all export formats with synthetic data of different sizes. Results
+are written as JSON and can be compared against a stored baseline.
+
+Usage: python benchmarks/run_benchmarks.py [--sizes 1000,10000,100000] [--output FILE]
+                                           [--baseline FILE | --no-baseline] [--save-baseline FILE]
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import platform
+import tempfile
+from io import StringIO
+from time import perf_counter
+from contextlib import redirect_stdout
+from dataclasses import replace
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_PATH)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bbst.data import TeacherIndex
+from bbst.fileops import (iter_bbsv_file, read_bbsv_file, read_teacher_list, write_teacher_list,
+                          write_moodle_file, write_radius_file, write_webuntis_file,
+                          write_logodidact_file, write_nbc_file)
+from bbst.pdf import create_user_info_document
+from generate_bbsv import write_bbsv_file
+
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+# baseline recorded with --save-baseline, see the machine information in the file
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# allowed slowdown compared to the baseline before a case counts as regression
+DEFAULT_TOLERANCE = 0.25
+
+
+def prepare_data(working_dir, size):
+    """
+    Generates an export file and the teachers lists needed by all cases.
+
+    :return: dictionary with file names and teachers lists
+    """
+    # every size gets its own directory, so that no output file is overwritten
+    working_dir = os.path.join(working_dir, str(size))
+    os.mkdir(working_dir)
+    export_file = os.path.join(working_dir, 'export_{}.csv'.format(size))
+    write_bbsv_file(export_file, size)
+    teachers = [row.to_teacher() for row in iter_bbsv_file(export_file)]
+    # the repo knows all teachers from the export except the new ones
+    repo = [t for t in teachers if not t.added]
+    # export all teachers, so that every format has to write the whole list
+    exported = [replace(t, added=True) for t in teachers]
+    teacher_list_file = os.path.join(working_dir, 'teacher_list_{}.csv'.format(size))
+    write_teacher_list(repo, teacher_list_file)
+    return {'export_file': export_file, 'teacher_list_file': teacher_list_file,
+            'repo': repo, 'exported': exported, 'working_dir': working_dir}
+
+def _output(data, file_name):
+    return os.path.join(data['working_dir'], file_name)
+
+def _reconcile(data):
+    TeacherIndex(data['repo']).reconcile(iter_bbsv_file(data['export_file']), blacklist=set())
+
+CASES = {
+    'read_bbsv_file': lambda d: read_bbsv_file(d['export_file']),
+    'update_reconcile': _reconcile,
+    'read_teacher_list': lambda d: read_teacher_list(d['teacher_list_file']),
+    'write_teacher_list': lambda d: write_teacher_list(d['repo'], _output(d, 'written_list.csv')),
+    'write_moodle_file': lambda d: write_moodle_file(d['exported'], _output(d, 'Moodle.csv')),
+    'write_radius_file': lambda d: write_radius_file(d['exported'], _output(d, 'Radius.csv')),
+    'write_webuntis_file': lambda d: write_webuntis_file(d['exported'], _output(d, 'Webuntis.csv')),
+    'write_logodidact_file': lambda d: write_logodidact_file(d['exported'], _output(d, 'Logodidact.csv')),
+    'write_nbc_file': lambda d: write_nbc_file(d['exported'], _output(d, 'NBC.csv')),
+    'create_user_info_document': lambda d: create_user_info_document(_output(d, 'Anschreiben.pdf'),
+                                                                     d['exported'], template=True),
+    # default layout with flowables as used by the print command
+    'create_user_info_document_flowables': lambda d: create_user_info_document(_output(d, 'Anschreiben_flowables.pdf'),
+                                                                               d['exported']),
+}
+
+def run_case(case, data, repeat):
+    """Returns the best wall time of all repetitions in seconds."""
+    timings = []
+    for _ in range(repeat):
+        # hide messages printed by the functions under test
+        with redirect_stdout(StringIO()):
+            start = perf_counter()
+            case(data)
+            timings.append(perf_counter() - start)
+    return min(timings)
+
+def run_suite(sizes, cases, repeat):
+    results = {}
+    working_dir = tempfile.mkdtemp(prefix='bbst-benchmark-')
+    # the user info documents need the logo in the working directory
+    shutil.copy(os.path.join(REPO_PATH, 'logo.png'), working_dir)
+    old_dir = os.getcwd()
+    os.chdir(working_dir)
+    try:
+        for size in sizes:
+            data = prepare_data(working_dir, size)
+            results[str(size)] = {}
+            for name in cases:
+                seconds = run_case(CASES[name], data, repeat)
+                results[str(size)][name] = seconds
+                print('{:>7} {:<36} {:>9.3f} s'.format(size, name, seconds), file=sys.stderr)
+    finally:
+        os.chdir(old_dir)
+        shutil.rmtree(working_dir, ignore_errors=True)
+    return {'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'results': results}
+
+def compare(report, baseline, tolerance):
+    """
+    Compares all results with a baseline.
+
+    :return: list of regressions as tuples of size, case, baseline and current time
+    """
+    regressions = []
+    for size, cases in report['results'].items():
+        for name, seconds in cases.items():
+            reference = baseline.get('results', {}).get(size, {}).get(name)
+            if reference is None:
+                continue
+            ratio = seconds / reference if reference else 1.0
+            print('{:>7} {:<36} {:>9.3f} s  baseline {:>9.3f} s  {:>+6.0%}'.format(
+                  size, name, seconds, reference, ratio - 1), file=sys.stderr)
+            if ratio > 1 + tolerance:
+                regressions.append((size, name, reference, seconds))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark suite for bbst')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES),
+                        help='comma-separated numbers of teachers')
+    parser.add_argument('--cases', default=','.join(CASES), help='comma-separated names of cases')
+    parser.add_argument('--repeat', type=int, default=1, help='repetitions per case, the best is used')
+    parser.add_argument('--output', help='file for the results in JSON format (default: stdout)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='JSON file with results to compare against (default: benchmarks/baseline.json)')
+    parser.add_argument('--no-baseline', action='store_true', help='does not compare against a baseline')
+    parser.add_argument('--save-baseline', help='stores the results as new baseline in the given file')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='allowed slowdown compared to the baseline (0.25 = 25%%)')
+    args = parser.parse_args()
+
+    cases = args.cases.split(',')
+    unknown = [c for c in cases if c not in CASES]
+    if unknown:
+        parser.error('unknown cases: {}'.format(', '.join(unknown)))
+    report = run_suite([int(s) for s in args.sizes.split(',')], cases, args.repeat)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            f.write(output)
+    if args.baseline and not args.no_baseline:
+        try:
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print('Baseline {} not found, results are not compared.'.format(args.baseline), file=sys.stderr)
+            return 0
+        machine = ('python', 'platform', 'cpus')
+        if any(baseline.get(k) != report.get(k) for k in machine):
+            print('Warning: baseline was recorded on a different machine ({}).'.format(
+                  ', '.join(str(baseline.get(k)) for k in machine)), file=sys.stderr)
+        regressions = compare(report, baseline, args.tolerance)
+        for size, name, reference, seconds in regressions:
+            print('Regression: {} with {} teachers took {:.3f} s instead of {:.3f} s.'.format(
+                  name, size, seconds, reference), file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#! /usr/bin/env python3
+
+"""
+Measures the start-up time of bbst_cli.py with the import-time breakdown of
+the Python interpreter (python -X importtime) and fails when the import time
+exceeds a given budget or when heavy dependencies are imported at start-up.
+
+Usage: python benchmarks/startup.py [--budget MS] [--runs N] [--top N]
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+from time import perf_counter
+from statistics import median
+
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_BUDGET_MS = 250
+# packages that must only be imported by the commands needing them
+LAZY_MODULES = ('reportlab', 'pypdf', 'tabulate', 'prompt_toolkit', 'bbst.pdf')
+
+
+def measure_import_times(module='bbst_cli'):
+    """
+    Imports the given module in a new interpreter and returns the cumulative
+    import time for all imported modules in microseconds.
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+                            cwd=REPO_PATH, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                            universal_newlines=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+def measure_wall_time():
+    """Returns the wall time in milliseconds for printing the version of the tool."""
+    # run in an empty directory, because the tool writes its log file into the working directory
+    with tempfile.TemporaryDirectory() as working_dir:
+        start = perf_counter()
+        subprocess.run([sys.executable, os.path.join(REPO_PATH, 'bbst_cli.py'), '--version'], cwd=working_dir,
+                       stdout=subprocess.DEVNULL, check=True)
+        return (perf_counter() - start) * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description='Start-up benchmark for bbst_cli.py')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_MS,
+                        help='maximum import time of bbst_cli in milliseconds')
+    parser.add_argument('--runs', type=int, default=5, help='number of measurements')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest imports to show')
+    args = parser.parse_args()
+
+    runs = [measure_import_times() for _ in range(args.runs)]
+    total_ms = median(r['bbst_cli'] for r in runs) / 1000
+    wall_ms = median(measure_wall_time() for _ in range(args.runs))
+    last_run = runs[-1]
+
+    print('Slowest imports (cumulative):')
+    slowest = sorted(((t, n) for n, t in last_run.items() if n != 'bbst_cli'), reverse=True)
+    for t, n in slowest[:args.top]:
+        print('   {:<40} {:>8.1f} ms'.format(n, t / 1000))
+    print('Import time of bbst_cli:  {:>8.1f} ms (budget {:.0f} ms)'.format(total_ms, args.budget))
+    print('Wall time of --version:   {:>8.1f} ms'.format(wall_ms))
+
+    failed = False
+    eager = sorted(n for n in last_run if n.split('.')[0] in LAZY_MODULES or n in LAZY_MODULES)
+    if eager:
+        print('Error: Modules imported at start-up that should be lazy: {}'.format(', '.join(eager)))
+        failed = True
+    if total_ms > args.budget:
+        print('Error: Import time exceeds budget by {:.1f} ms.'.format(total_ms - args.budget))
+        failed = True
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())